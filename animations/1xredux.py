@@ -12,15 +12,19 @@ FADEIN_LENGTH = 69
 FADEOUT_LENGTH = 120
 
 # Audio mod generator
-class Fractal(ScreenPart, ComplexPlane):
+class Fractal(ScreenPart, ComplexPlane, EscapeTimePlane):
     def __init__(self, window_size, c = None, color_vector = bright_color_factory):
         ScreenPart.__init__(self, window_size)
+        EscapeTimePlane.__init__(self, color_vector)
+        # Animation views are seldom seen again, don't fill the tile cache
+        self.buffer.save_tiles = False
         self.c = c
         self.set_view(0j, 1)
         self.max_iter = 73.
         self.hue = 0.5
         self.last_view = None
-        self.color_vector = color_vector
+        # Area of the points drawn over the last render
+        self.drawn = None
 
     def draw_complex(self, plane_coord, color = 0xffffff):
         coord = (int((plane_coord.real - self.offset[0]) * self.scale[0]),
@@ -28,19 +32,32 @@ class Fractal(ScreenPart, ComplexPlane):
         if coord[0] < 0 or coord[1] < 0 or coord[1] >= self.pixels.shape[1] or coord[0] >= self.pixels.shape[0]:
             return
         self.pixels[coord[0]][coord[1]] = color
+        point = pygame.Rect(coord, (1, 1))
+        if self.drawn is None:
+            self.drawn = point
+        else:
+            self.drawn.union_ip(point)
+        self.invalidate(point)
+
+    def colorize(self, counts):
+        return self.palette.get(self.max_iter, self.hue)[counts]
 
     def render(self):
         if not self.window_size[0]:
             return
         if self.c is None:
             if (self.center, self.radius) == self.last_view:
-                # Reuse pre-render
-                self.pixels = self.pixels_copy.copy()
+                # Reuse pre-render, only erasing the points drawn over it
+                if self.drawn is not None:
+                    x, y, width, height = self.drawn
+                    self.pixels[x:x + width, y:y + height] = self.pixels_copy[x:x + width, y:y + height]
+                    self.invalidate(self.drawn)
+                    self.drawn = None
                 return
             self.last_view = (self.center, self.radius)
-        nparray = compute(complex_fractal, [self.window_size, self.offset, self.scale, self.max_iter, self.c, self.length])
-        nparray = np.vectorize(self.color_vector(self.max_iter, self.hue))(nparray)
+        nparray = self.colorize(self.buffer.render(self.view(), self.kernel()))
         self.pixels = nparray.reshape(*self.window_size)
+        self.drawn = None
         if self.c is None: # Keep mandelbrot render
             self.pixels_copy = self.pixels.copy()
 
@@ -60,10 +77,32 @@ HIGHF=0
 MIDF=1
 LOWF=2
 
+FEATURE_DTYPE=np.dtype([("freqs", "f8", (len(FREQS),)), ("high_speed", "f8"), ("mid_speed", "f8")])
+def feature_table(table):
+    # The FREQS mods and speeds of every frame of a spectrogram table
+    features = np.zeros(len(table), dtype=FEATURE_DTYPE)
+    for idx in xrange(len(FREQS)):
+        current, freq_range, clip, scale, decay = FREQS[idx]
+        if not freq_range:
+            continue
+        vals = np.median(table[:, freq_range[0]:freq_range[1]], axis=1).astype('f8')
+        if clip:
+            vals = np.maximum(0, vals - clip)
+        vals = np.minimum(1., vals * scale)
+        features["freqs"][:, idx] = envelope_follower(vals, decay)
+    # speed -= speed / 12.; speed += (1 - speed) / 3. * high
+    high = features["freqs"][:, HIGHF]
+    features["high_speed"] = np.minimum(1, linear_recurrence((1 - 1 / 12.) * (1 - high / 3.), high / 3.))
+    # speed -= speed / 4.; speed += (1 - speed) / 4. * mid
+    mid = features["freqs"][:, MIDF]
+    features["mid_speed"] = np.minimum(1, linear_recurrence((1 - 1 / 4.) * (1 - mid / 4.), mid / 4.))
+    return features
+
 class Modulator(ScreenPart):
-    def __init__(self, window_size, bpm, fps, end_frame, args):
+    def __init__(self, window_size, bpm, fps, end_frame, args, features):
         ScreenPart.__init__(self, window_size)
         self.freqs = FREQS
+        self.features = features
         self.c_num_draw = 42
         self.c_values = []
         self.fps = fps
@@ -128,26 +167,14 @@ class Modulator(ScreenPart):
             radius = self.scales[idx][1][pos]
         ft.set_view(center = center, radius = radius)
 
-    def update(self, frame, spectrogram, main_ft, debug_ft):
+    def update(self, frame, main_ft, debug_ft):
         # Update mods
-        for freq in self.freqs:
-            current, freq_range, clip, scale, decay = freq
-            if not freq_range:
-                continue
-            vals = spectrogram.freq[freq_range[0]:freq_range[1]]
-            val = np.median(vals)
-            if clip:
-                val = max(0, val - clip)
-            val = min(1., val * scale)
-            if val > current:
-                freq[0] = val
-            else:
-                freq[0] -= (current - val) / decay
-
-        self.high_speed -= self.high_speed / 12.
-        self.high_speed = min(1, self.high_speed + (1 - self.high_speed) / 3. * self.freqs[0][0])
-        self.mid_speed -= self.mid_speed / 4.
-        self.mid_speed = min(1, self.mid_speed + (1. - self.mid_speed) / 4. * self.freqs[1][0])
+        features = self.features[frame]
+        for idx in xrange(len(self.freqs)):
+            if self.freqs[idx][1]:
+                self.freqs[idx][0] = features["freqs"][idx]
+        self.high_speed = features["high_speed"]
+        self.mid_speed = features["mid_speed"]
 
         self.draw_point = [
             (self.freqs[HIGHF][0], self.high_speed, 0x008080),
@@ -207,6 +234,8 @@ class Modulator(ScreenPart):
             self.debug_ft.set_view(center = 0j, radius = 1.5)
             self.fadein_radius = 1.3
             self.main_ft.c = 1+1.3j
+            # Mostly black outside of the set, fill it by rectangles
+            self.main_ft.subdivide = True
             self.fadein_zoom_length = self.scenes_name["bells"][1] + self.scenes_name["fadein"][1]
 
         # Zoom in for the next 2 scenes
@@ -231,6 +260,7 @@ class Modulator(ScreenPart):
 
     def intro_t(self):
         if self.scene_init:
+            self.main_ft.subdivide = False
             self.mod_center = BULB_2_CENTER
             self.angle = 10
 
@@ -385,6 +415,7 @@ class Modulator(ScreenPart):
 
     def fadeout(self):
         if self.scene_init:
+            self.main_ft.subdivide = True
             self.c_path = np.linspace(self.main_ft.c, -5+0j, self.scene_length)
         self.move_view(self.main_ft, center = 0j, radius = 3.0)
         self.move_view(self.debug_ft, center = 0j, radius = 3.5)
@@ -400,9 +431,9 @@ class Modulator(ScreenPart):
             if pos:
                 self.pixels[cur_pos][y_split * pos] = 0x4e4e4e
             f, s, c = freq
-            self.pixels[cur_pos][-1 + (pos + 1 ) * y_split - y_split * f] = c
+            self.pixels[cur_pos][int(-1 + (pos + 1 ) * y_split - y_split * f)] = c
             if s:
-                self.pixels[cur_pos][-1 + (pos + 1 ) * y_split - y_split * s] = ~c
+                self.pixels[cur_pos][int(-1 + (pos + 1 ) * y_split - y_split * s)] = ~c
             pos += 1
 
         for idx in xrange(len(self.c_values)):
@@ -411,9 +442,85 @@ class Modulator(ScreenPart):
             point = self.c_values[idx]
             debug_ft.draw_complex(point, rgb(*[1 * (self.c_num_draw - 1 - idx) / float(self.c_num_draw)] * 3))
 
+def load_audio(args):
+    # The intro and outro black frames are silent
+    wav = AudioSource(args.wav, args.fps, FADEIN_LENGTH, FADEOUT_LENGTH)
+    freq, audio_frame_size = wav.freq, wav.frame_size
+    wav_length = len(wav.data) / audio_frame_size
+    audio_frames = np.linspace(0, len(wav), int(len(wav) / freq * args.fps), endpoint=False).astype(int)
+    return freq, wav, audio_frame_size, wav_length, audio_frames
+
+def encode(args, dname, start_frame, wav, audio_start, sink = None):
+    fname = "out.webm"
+    pygame.display.quit()
+    wav.write("%s/audio.wav" % dname, audio_start)
+    mplayer = " ".join(["mplayer", "-zoom", "-vo", "x11", "-fs", "%s/%s" % (dname, fname)])
+    if sink is not None:
+        # Flush the frames, the encoder sink also muxes the audio
+        sink.close("%s/audio.wav" % dname)
+    if args.sink == "encoder":
+        print mplayer
+    else:
+        ffmpeg = " ".join([
+            "ffmpeg", "-y", "-framerate", "%d" % args.fps, "-start_number", "%d" % start_frame,
+            "-i", "%s/%%04d.png" % dname, "-i", "%s/audio.wav" % dname, "-c:v", "libvpx", "-threads", "4",
+            "-b:v", "5M", "-c:a", "libvorbis", "%s/%s" % (dname, fname)])
+        print "%s && \\\n  %s" % (ffmpeg, mplayer)
+        if not args.encode:
+            return
+        os.system("%s &> /dev/null" % ffmpeg)
+    if args.encode and "DISPLAY" in os.environ:
+        raw_input("Press enter to play...")
+        os.system("%s &> /dev/null" % mplayer)
+
+def render_track(args):
+    # Render a frame range of the track, without audio analysis nor scenes
+    track = load_track(args.track)
+    if args.scene:
+        scene_frames = np.flatnonzero(track["scene"] == args.scene)
+        start_frame, end_frame = scene_frames[0] + args.start, scene_frames[-1] + 1
+        if args.stop != 9001:
+            end_frame = scene_frames[0] + args.stop
+        if args.scene_stop:
+            end_frame = np.flatnonzero(track["scene"] == args.scene_stop)[-1] + 1
+    else:
+        start_frame = args.start
+        end_frame = min(len(track), args.stop + FADEIN_LENGTH)
+    dname = args.record
+
+    if dname:
+        sink = frame_sink(dname, WINSIZE, args.fps, args.sink)
+        render_track_frames(track, WINSIZE, Palette(bright_color_factory), (), range(start_frame, end_frame), sink)
+        if args.wav:
+            freq, wav, audio_frame_size, wav_length, audio_frames = load_audio(args)
+            encode(args, dname, start_frame, wav, audio_frames[start_frame], sink)
+        else:
+            sink.close()
+        return
+
+    screen = Screen(WINSIZE)
+    main_ft = Fractal(WINSIZE)
+    screen.add(main_ft)
+    counts = SharedArray()
+    # Live, render frame by frame
+    for frame in xrange(start_frame, end_frame):
+        start_time = time.time()
+        row = track[frame]
+        frame_counts = compute_track(main_ft.window_size, track[frame:frame + 1], counts)
+        main_ft.pixels = main_ft.palette.get(row["max_iter"], row["hue"])[frame_counts[0]]
+        screen.update()
+        screen.flip()
+        sys.stdout.write("\r[%04d] %02d %% (%.2f sec per frame)" % (
+            row["frame"], 100. * (row["frame"] + 1 - start_frame) / (end_frame - start_frame),
+            time.time() - start_time))
+        sys.stdout.flush()
+        for e in poll_events():
+            if e.type == KEYDOWN and e.key == K_ESCAPE: exit(0)
+    print
+
 def main(argv):
     parser = argparse.ArgumentParser()
-    parser.add_argument("--wav", required = True)
+    parser.add_argument("--wav")
     parser.add_argument("--play", action="store_const", const=True)
     parser.add_argument("--encode", action="store_const", const=True)
     parser.add_argument("--bpm", type=float, default=105.)
@@ -426,20 +533,30 @@ def main(argv):
     parser.add_argument("--debug", action="store_const", const=True)
     parser.add_argument("--single", action="store_const", const=True)
     parser.add_argument("--record", type=str)
+    parser.add_argument("--parallel", action="store_const", const=True,
+                        help="record from a track of the scenes, rendering the frames in parallel")
+    parser.add_argument("--sink", choices=("png", "encoder"), default="png",
+                        help="write the recorded frames as pngs or stream them to the encoder")
+    parser.add_argument("--export-track", help="only compute the scene parameters of every frame into this file")
+    parser.add_argument("--track", help="render the frames of a track file")
     args = parser.parse_args()
 
-    if args.encode and not args.record:
+    if (args.encode or args.parallel) and not args.record:
         print "You need to specify --record directory"
         exit(1)
 
-    freq, wav = scipy.io.wavfile.read(args.wav)
-    audio_frame_size = freq / args.fps
-    # Inject intro black data
-    wav_length = len(wav) / audio_frame_size
-    wav = np.concatenate((np.zeros(shape=(audio_frame_size * FADEIN_LENGTH, 2), dtype='i2'), wav, np.zeros(shape=(audio_frame_size * FADEOUT_LENGTH, 2), dtype='i2')))
-    audio_frames = np.linspace(0, len(wav), int(len(wav) / freq * args.fps), endpoint=False)
+    if args.track:
+        render_track(args)
+        return
+
+    if not args.wav:
+        print "You need to specify --wav file"
+        exit(1)
+
+    freq, wav, audio_frame_size, wav_length, audio_frames = load_audio(args)
     spectrogram = SpectroGram(audio_frame_size)
-    mod = Modulator((MOD_WIDTH, SG_HEIGHT), args.bpm, args.fps, wav_length, args)
+    spectrogram.precompute(wav, audio_frames, args.wav, args.fps)
+    mod = Modulator((MOD_WIDTH, SG_HEIGHT), args.bpm, args.fps, wav_length, args, feature_table(spectrogram.table))
 
     if args.scene:
         s = mod.scenes_name[args.scene]
@@ -453,8 +570,30 @@ def main(argv):
         start_frame = args.start
         end_frame = min(len(audio_frames), args.stop + FADEIN_LENGTH)
 
+    if args.parallel:
+        if args.debug or args.debugo:
+            print "Parallel record doesn't render the debug views"
+            exit(1)
+        args.export_track = record_track_path(args.record)
+
+    if args.export_track:
+        # Only update the scenes, without rendering
+        main_ft = Fractal(WINSIZE)
+        debug_ft = Fractal((WAV_WIDTH, SG_HEIGHT), color_vector = dark_color_factory)
+        debug_ft.max_iter = 69.
+        track = []
+        for frame in xrange(end_frame):
+            scene_name = mod.update(frame, main_ft, debug_ft)
+            track.append((frame, main_ft.c, main_ft.center, main_ft.radius, main_ft.hue, main_ft.max_iter,
+                          main_ft.subdivide, scene_name))
+        save_track(args.export_track, track)
+        if args.record:
+            args.track = args.export_track
+            render_track(args)
+        return
+
     if args.play:
-        pygame.mixer.init(frequency = freq, channels = len(wav[0]), buffer = audio_frame_size)
+        pygame.mixer.init(frequency = freq, channels = wav.channels, buffer = audio_frame_size)
 
     screen = Screen(WINSIZE)
     waterfall = Waterfall((WINSIZE[0] - WAV_WIDTH - MOD_WIDTH, SG_HEIGHT), audio_frame_size)
@@ -487,6 +626,7 @@ def main(argv):
     if args.record:
         dname = args.record
         args.play = None
+        screen.sink = AsyncSink(frame_sink(dname, WINSIZE, args.fps, args.sink))
     else:
         dname = None
 
@@ -495,13 +635,14 @@ def main(argv):
     last_fps = (-2, time.time())
     render_speed = -1
     last_render_speed = render_speed
+    player = None
 
     # Init
     while True:
         start_time = time.time()
         audio_buf = wav[audio_frames[frame]:audio_frames[frame]+audio_frame_size]
-        spectrogram.transform(audio_buf)
-        scene_name = mod.update(frame, spectrogram, main_ft, debug_ft)
+        spectrogram.seek(frame)
+        scene_name = mod.update(frame, main_ft, debug_ft)
 
         if frame >= start_frame:
             wavgraph.render(audio_buf)
@@ -518,7 +659,7 @@ def main(argv):
             c_str = "%s: z*z%s%.6f%s%.6fj" % (scene_name, r_sign, main_ft.c.real, i_sign, main_ft.c.imag)
             if not args.debugo and args.debug and WINSIZE[0] > 50:
                 screen.draw_msg("[%04d] %s" % (frame, c_str))
-            pygame.display.update()
+            screen.flip()
             if dname:
                 screen.capture(dname, frame)
 
@@ -544,34 +685,22 @@ def main(argv):
 
 
         if frame == start_frame and args.play:
-            sound = pygame.mixer.Sound(array = wav[audio_frames[start_frame]:])
-            sound.play()
+            player = AudioPlayer(wav, audio_frames[start_frame])
+            player.play()
 
         frame += 1
         if frame >= end_frame:
             print
             if dname:
-                fname = "out.webm"
-                pygame.display.quit()
-                wav = wav[audio_frames[start_frame]:]
-                scipy.io.wavfile.write("%s/audio.wav" % dname, freq, wav)
-                ffmpeg = " ".join([
-                    "ffmpeg", "-y", "-framerate", "%d" % args.fps, "-start_number", "%d" % start_frame,
-                    "-i", "%s/%%04d.png" % dname, "-i", "%s/audio.wav" % dname, "-c:v", "libvpx", "-threads", "4",
-                    "-b:v", "5M", "-c:a", "libvorbis", "%s/%s" % (dname, fname)])
-                mplayer = " ".join(["mplayer", "-zoom", "-vo", "x11", "-fs", "%s/%s" % (dname, fname)])
-                print "%s && \\\n  %s" % (ffmpeg, mplayer)
-                if args.encode:
-                    os.system("%s &> /dev/null" % ffmpeg)
-                    if "DISPLAY" in os.environ:
-                        raw_input("Press enter to play...")
-                        os.system("%s &> /dev/null" % mplayer)
+                encode(args, dname, start_frame, wav, audio_frames[start_frame], screen.sink)
             break
 
-        for e in pygame.event.get():
+        for e in poll_events():
             if  e.type == MOUSEBUTTONDOWN: print e.pos
             elif e.type == KEYDOWN and e.key == K_ESCAPE: exit(0)
 
+        if player is not None:
+            player.update()
         if frame >= start_frame:
             clock.tick(args.fps)
 
@@ -581,7 +710,5 @@ if __name__ == "__main__":
         main(sys.argv)
     except KeyboardInterrupt:
         print
-        if pool:
-            pool.terminate()
-            pool.join()
+        backend.terminate()
         raise
@@ -15,56 +15,82 @@ PHI = (1+math.sqrt(5))/2.0
 # export SDL_VIDEODRIVER=dummy
 # export SDL_AUDIODRIVER=dummy
 
-lowmod = AudioMod("tokyoloop_lowmono.wav", MAX_FRAMES, filter_type = 1, delay = 15.0)
-midmod = AudioMod("tokyoloop_allmono.wav", MAX_FRAMES, filter_type = 2, delay = 20.0)
+def load_mods():
+    global lowmod, midmod
+    lowmod = AudioMod("tokyoloop_lowmono.wav", MAX_FRAMES, filter_type = 1, delay = 15.0)
+    midmod = AudioMod("tokyoloop_allmono.wav", MAX_FRAMES, filter_type = 2, delay = 20.0)
 
-#lowmod.plot()
-#midmod.plot()
+    #lowmod.plot()
+    #midmod.plot()
+
+def tokyo_color_factory(scale, hue, max_iter):
+    def tokyo_color(x):
+        if x + 1 >= scale:
+            return 0
+        return hsv(hue + x / (0.1 * max_iter), 0.7, 0.7)
+    return tokyo_color
 
 class JuliaSet:
+    max_iter = 69 * 6
+
     def __init__(self):
         self.c = 0j
         self.escape_limit = 1e150
-        self.max_iter = 69 * 6
         self.effective_max_iter = 69
         self.hue = 0.40
+        self.palette = Palette(tokyo_color_factory)
+        self.counts = SharedArray()
 
-    def render(self, plane, frame):
+    def render(self, plane, frames):
+        # Render a block of (frame, c, center, radius) at once, and yield
+        # each frame once it is drawn on the plane
         start_time = time.time()
-        plane.fill((0, 0, 0))
-        self.draw_fractal(plane, frame)
-        print "%04d: %.2f sec: c/center/radius = '%s' '%s' %s" % (frame, time.time() - start_time, self.c, plane.center, plane.radius)
-
-    def draw_fractal(self, plane, frame):
-        for y in xrange(WINSIZE[1]):
-            for x in xrange(WINSIZE[0]):
-                z = plane.convert_to_plane((x, y))
-                for i in xrange(0, self.effective_max_iter):
-                    z = z * z + self.c
-                    if abs(z.real) > self.escape_limit or abs(z.imag) > self.escape_limit:
-                        break
-                if i + 1 == self.effective_max_iter:
-                    continue
-                hue = self.hue + i / (0.1 * self.max_iter)
-                color = map(lambda x: x*255, colorsys.hsv_to_rgb(hue, 0.7, 0.7))
-                plane.draw_point((x,y), color)
-
-        if False:
-            plane.draw_axis()
-            # debug, draw dot
-            plane.draw_complex(c, (255, 0, 0))
-
-        # debug, draw formula
-        if self.c.real >= 0: r_sign = "+"
-        else:                r_sign = ""
-        if self.c.imag >= 0: i_sign = "+"
-        else:                i_sign = ""
-        c_str = "[%04d] z*z%s%.5f%s%.5fj" % (frame, r_sign, self.c.real, i_sign, self.c.imag)
-#        plane.draw_msg(c_str)
-#        plane.draw_msg("mod %02.3f / %02.3f" % (lowmod.get(frame), midmod.get(frame)), coord = (5, 20))
-
+        counts = compute_frames(plane.window_size, map(lambda x: x[1:] + (self.effective_max_iter,), frames), self.counts)
+        colors = self.palette.get(self.effective_max_iter, self.hue, self.max_iter)[counts]
+        elapsed = (time.time() - start_time) / len(frames)
+        for idx in xrange(len(frames)):
+            frame, c, center, radius = frames[idx]
+            plane.blit(colors[idx])
+            print "%04d: %.2f sec: c/center/radius = '%s' '%s' %s" % (frame, elapsed, c, center, radius)
+            yield frame
+
+
+def render_track(fname, start_frame, end_frame):
+    # Play or record a frame range of an exported track
+    track = load_track(fname)
+    end_frame = min(end_frame, len(track))
+    if "RECORD_DIR" in os.environ:
+        sink = frame_sink(os.environ["RECORD_DIR"], WINSIZE)
+        render_track_frames(track, WINSIZE, Palette(tokyo_color_factory), (JuliaSet.max_iter,), range(start_frame, end_frame), sink)
+        sink.close(os.environ.get("WAV"), start_frame / 25.)
+        return
+    screen = Screen(WINSIZE)
+    scene = JuliaSet()
+    plane = Plane(WINSIZE)
+    screen.add(plane)
+    # Live, render frame by frame
+    for frame in xrange(start_frame, end_frame):
+        rows = track[frame:frame + 1]
+        for rendered_frame in scene.render(plane, zip(rows["frame"], rows["c"], rows["center"], rows["radius"])):
+            screen.update()
+        for e in poll_events():
+            if e.type == KEYDOWN and e.key == K_ESCAPE: exit(0)
 
 def main(argv):
+    # Usage: [--export-track file | --track file] [start_frame [end_frame [debug_view debug_radius]]]
+    export_track = None
+    if len(argv) >= 3 and argv[1] in ("--export-track", "--track"):
+        option, fname = argv[1:3]
+        argv = argv[:1] + argv[3:]
+        if option == "--track":
+            start_frame, end_frame = 0, MAX_FRAMES
+            if len(argv) >= 2: start_frame = int(argv[1])
+            if len(argv) >= 3: end_frame = int(argv[2])
+            render_track(fname, start_frame, end_frame)
+            return
+        export_track = fname
+    load_mods()
+
     frame = 0
     start_frame = 0
     end_frame = MAX_FRAMES
@@ -79,17 +105,22 @@ def main(argv):
         if len (argv) == 5:
             debug_view = complex(argv[3])
             debug_radius = float(argv[4])
-    if not debug_path and "RECORD_DIR" in os.environ and "PYRENDER_THREAD" not in os.environ:
-        os.environ["PYRENDER_THREAD"] = "1"
-        parallel_main(start_frame, end_frame)
+    record_track = not export_track and not debug_path and "RECORD_DIR" in os.environ
+    if record_track:
+        export_track = record_track_path(os.environ["RECORD_DIR"])
+    if export_track:
+        # The main loop only collects the track, as for the debug path
+        debug_path = True
+        track = []
 
     screen = Screen(WINSIZE)
     scene = JuliaSet()
     clock = pygame.time.Clock()
-    plane = ComplexPlane(WINSIZE)
+    plane = Plane(WINSIZE)
     screen.add(plane)
 
     all_c_values = []
+    frames = []
     def plot_c_values(start_point = 0, set_view = True):
         if set_view:
             plane.set_view(center = debug_view, radius = debug_radius)
@@ -118,7 +149,8 @@ def main(argv):
                 txt_coord[1] -= 10
                 plane.draw_msg(str(idx), txt_coord)
             idx += 1
-        pygame.display.update()
+        if not HEADLESS:
+            pygame.display.update()
 
     while True:
         # Animation 'scenes' description bellow:
@@ -329,7 +361,7 @@ def main(argv):
                 plane.set_view(center = 0j, radius = 3.0)
                 c_path = np.linspace(-2.3+0j, -1.42+0j, scene_len)
             mod = complex(-0.01, PHI * -0.17 * lowmod.get(frame))
-            scene.c = c_path[frame -scene_len] + mod
+            scene.c = c_path[int(frame - scene_len)] + mod
 
 
         # Mid freq modulate hue
@@ -338,30 +370,45 @@ def main(argv):
         # scene.hue = 0.40 + 0.13 * lowmod.get(frame)
 
 
+        if export_track:
+            track.append((frame, scene.c, plane.center, plane.radius, scene.hue, scene.effective_max_iter, False, ""))
+
         if frame >= start_frame:
             all_c_values.append(scene.c)
             if not debug_path:
-                scene.render(plane, frame)
-                screen.update()
-                if "RECORD_DIR" in os.environ:
-                    screen.capture(frame)
+                frames.append((frame, scene.c, plane.center, plane.radius))
 
         frame += 1
+        if frames:
+            for rendered_frame in scene.render(plane, frames):
+                screen.update()
+                if "RECORD_DIR" in os.environ:
+                    screen.capture(os.environ["RECORD_DIR"], rendered_frame)
+            frames = []
         if frame >= end_frame:
             break
 
-        for e in pygame.event.get():
+        for e in poll_events():
             if  e.type == MOUSEBUTTONDOWN: print plane.convert_to_plane(e.pos)
             elif e.type == KEYDOWN and e.key == K_ESCAPE: exit(0)
 
+    if export_track:
+        save_track(export_track, track)
+        if record_track:
+            render_track(export_track, start_frame, end_frame)
+        return
+
     if not debug_path: #and "MID_RENDER" in os.environ:
         return
 
     if debug_path:
         plot_c_values(start_frame)
+    if HEADLESS:
+        # There is no input to explore the path
+        return
 
     while True:
-        for e in pygame.event.get():
+        for e in poll_events():
             if e.type not in (KEYDOWN, MOUSEBUTTONDOWN):
                 continue
             if e.type == MOUSEBUTTONDOWN:
@@ -377,31 +424,11 @@ def main(argv):
                     if debug_path:
                         plot_c_values(start_frame, False)
                     else:
-                        scene.render(plane, -1)
+                        for rendered_frame in scene.render(plane, [(-1, scene.c, plane.center, plane.radius)]):
+                            screen.update()
         clock.tick(25)
 
 
-def parallel_main(start_frame, end_frame):
-    if (end_frame - start_frame) % multiprocessing.cpu_count() != 0:
-        print "Wrong frame range..."
-        exit(1)
-    step = (end_frame - start_frame) / multiprocessing.cpu_count()
-    ranges = range(start_frame, end_frame, step)
-    process = []
-    os.environ["MID_RENDER"] = "1"
-    for i in ranges:
-        print "Starting %s %d %d" % (__file__, i, i+step)
-        if ranges[-1] == i:
-            del os.environ["MID_RENDER"]
-        process.append(
-            subprocess.Popen([__file__, str(i), str(i+step)])
-        )
-        time.sleep(0.5)
-    for p in process:
-        print "return code", p.wait()
-    exit(0)
-
-
 if __name__ == "__main__":
     try:
         main(sys.argv)
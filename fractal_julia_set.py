@@ -5,22 +5,21 @@
 from utils import *
 
 
-class JuliaSet(Window, ComplexPlane):
+class JuliaSet(Window, ComplexPlane, EscapeTimePlane):
     def __init__(self, window_size, c = complex(0, 0), escape_limit=1e100, max_iter=69):
         Window.__init__(self, window_size)
+        EscapeTimePlane.__init__(self, grayscale_color_factory)
         self.c = c
         self.max_iter = 69.
-        self.color_vector = np.vectorize(grayscale_color_factory(self.max_iter))
         self.set_view(0j, 3)
 
-    def render(self, frame):
-        start_time = time.time()
-        nparray = compute(complex_fractal, [self.window_size, self.offset, self.scale, self.max_iter, self.c, self.length])
-        self.blit(self.color_vector(nparray))
+    def draw_overlay(self):
         self.draw_axis()
         self.draw_function_msg()
         self.draw_cpoint()
-        print "%04d: %.2f sec: JuliaSet(c/center/radius = '%s' '%s' %s )" % (frame, time.time() - start_time, self.c, self.center, self.radius)
+
+    def log(self, frame, elapsed):
+        print "%04d: %.2f sec: JuliaSet(c/center/radius = '%s' '%s' %s )" % (frame, elapsed, self.c, self.center, self.radius)
 
     def draw_function_msg(self):
         if self.c.real >= 0: r_sign = "+"
@@ -47,6 +46,15 @@ seeds = (
     (0.28200+0.48000j),
 )
 
+def set_argv_view(scene, argv):
+    # Frame definition of the command line: c [center [radius]]
+    if len(argv) >= 1: scene.c = complex(argv[0])
+    if len(argv) >= 2: scene.set_view(center = complex(argv[1]))
+    if len(argv) >= 3: scene.set_view(radius = float(argv[2]))
+
+def new_scene(window_size):
+    return JuliaSet(window_size)
+
 def main(argv):
     if len(argv) == 1:
         print "JuliaSet explorer"
@@ -55,31 +63,34 @@ def main(argv):
         print "Click the window to center"
         print "Use keyboard arrow to move window, 'a'/'e' to zoom in/out, 'r' to reset view"
         print "Use 'qzsd' to change c value or RETURN key to browse known seeds"
+        print "Use 'm' to toggle rectangle subdivision rendering, 'p' to toggle progressive rendering"
 
     pygame.init()
     screen = Screen(WINSIZE)
     clock = pygame.time.Clock()
-    c = random.choice(seeds)
+    scene = JuliaSet(WINSIZE, random.choice(seeds))
     # Usage allow reuse of frame definition (c, plane center, radius)
-    if len(argv) >= 2: c = complex(argv[1])
-    if len(argv) >= 3: scene.set_view(center = complex(argv[2]))
-    if len(argv) >= 4: scene.set_view(radius = float(argv[3]))
-
-    scene = JuliaSet(WINSIZE, c)
+    set_argv_view(scene, argv[1:])
     screen.add(scene)
     frame = 0
     redraw = True
     while True:
         if redraw:
             frame += 1
-            scene.render(frame)
-            screen.update()
-            pygame.display.update()
-            redraw = False
-            if "RECORD_DIR" in os.environ:
-                screen.capture(frame, os.environ["RECORD_DIR"])
+            for stride in scene.render_passes(frame):
+                screen.update()
+                screen.flip()
+                # Stop refining when the view is about to change
+                if input_pending():
+                    break
+            redraw = stride > 1
+            if not redraw and "RECORD_DIR" in os.environ:
+                screen.capture(os.environ["RECORD_DIR"], frame)
+        if HEADLESS and not redraw:
+            # There is no input to change the view
+            return
 
-        for e in pygame.event.get():
+        for e in poll_events():
             if e.type not in (KEYDOWN, MOUSEBUTTONDOWN):
                 continue
             if e.type == MOUSEBUTTONDOWN:
@@ -118,6 +129,10 @@ def main(argv):
                     scene.set_view(center = scene.center + step)
                 elif e.key == K_r:
                     scene.set_view(center = 0j, radius = 1.5)
+                elif e.key == K_m:
+                    scene.subdivide = not scene.subdivide
+                elif e.key == K_p:
+                    scene.progressive = not scene.progressive
                 else:
                     redraw = False
                     continue
@@ -128,6 +143,4 @@ if __name__ == "__main__":
         main(sys.argv)
     except KeyboardInterrupt:
         pass
-    pool.terminate()
-    pool.join()
-    del pool
+    backend.terminate()
@@ -3,21 +3,58 @@
 
 from utils import *
 
-class MandelbrotSet(Window, ComplexPlane):
+class MandelbrotSet(Window, ComplexPlane, EscapeTimePlane):
     def __init__(self, window_size, max_iter=69):
         Window.__init__(self, window_size)
+        EscapeTimePlane.__init__(self, grayscale_color_factory)
         self.max_iter = float(max_iter)
-        self.color_vector = np.vectorize(grayscale_color_factory(self.max_iter))
-        self.color_vector = np.vectorize(grayscale_color_factory(self.max_iter))
+
+    def deep(self):
+        return self.radius < DEEP_ZOOM_RADIUS
+
+    def set_view(self, center = None, radius = None):
+        ComplexPlane.set_view(self, center, radius)
+        if self.deep():
+            # The plane bounds are too close to the center to give the radius
+            self.scale = (self.window_size[0] / (2. * self.radius), self.window_size[1] / (2. * self.radius))
+
+    def interlaced(self):
+        return EscapeTimePlane.interlaced(self) and not self.deep()
 
     def render(self, frame):
+        if not self.deep():
+            return EscapeTimePlane.render(self, frame)
         start_time = time.time()
-        nparray = compute(complex_fractal, [self.window_size, self.offset, self.scale, self.max_iter, None, self.length])
-        self.blit(self.color_vector(nparray))
-        self.draw_axis()
-        print "%04d: %.2f sec: MandelbrotSet(center/radius = '%s' %s )" % (frame, time.time() - start_time, self.center, self.radius)
+        # Beyond float64 precision, use perturbation from the center orbit
+        orbit = reference_orbit(self.hp_center, self.radius, self.max_iter)
+        series = series_approximation(orbit, self.radius)
+        self.blit(self.colorize(compute(perturbation_fractal, [self.window_size, self.radius, self.scale, self.max_iter, orbit, series, self.length])))
+        self.draw_overlay()
+        self.log(frame, time.time() - start_time)
+
+    def draw_overlay(self):
+        if not self.deep():
+            self.draw_axis()
+
+    def log(self, frame, elapsed):
+        if self.deep():
+            center = hp_str(self.hp_center)
+        else:
+            center = self.center
+        print "%04d: %.2f sec: MandelbrotSet(center/radius/max_iter = '%s' %s %d )" % (frame, elapsed, center, self.radius, self.max_iter)
 
 
+def set_argv_view(scene, argv):
+    # Frame definition of the command line: center [radius [max_iter]]
+    if len(argv) >= 1: scene.set_view(center = argv[0])
+    if len(argv) >= 2: scene.set_view(radius = float(argv[1]))
+    if len(argv) >= 3: scene.max_iter = float(argv[2])
+
+def new_scene(window_size):
+    scene = MandelbrotSet(window_size)
+    scene.set_view(center = -0.8, radius = 1.3)
+    return scene
+
 pids = set()
 def main(argv):
     if len(argv) == 1:
@@ -26,14 +63,13 @@ def main(argv):
         print ""
         print "Left/right click to zoom in/out, Middle click to draw JuliaSet"
         print "Use keyboard arrow to move view and r to reset"
+        print "Use 'm' to toggle rectangle subdivision rendering, 'p' to toggle progressive rendering"
 
     screen = Screen(WINSIZE)
     clock = pygame.time.Clock()
-    scene = MandelbrotSet(WINSIZE)
-    scene.set_view(center = -0.8, radius = 1.3)
-    # Usage allow reuse of frame definition (c, plane center, radius)
-    if len(argv) >= 2: scene.set_view(center = complex(argv[1]))
-    if len(argv) >= 3: scene.set_view(radius = float(argv[2]))
+    scene = new_scene(WINSIZE)
+    # Usage allow reuse of frame definition (plane center, radius, max_iter)
+    set_argv_view(scene, argv[1:])
 
     screen.add(scene)
     frame = 0
@@ -41,14 +77,20 @@ def main(argv):
     while True:
         if redraw:
             frame += 1
-            scene.render(frame)
-            screen.update()
-            pygame.display.update()
-            redraw = False
-            if "RECORD_DIR" in os.environ:
-                screen.capture(frame, os.environ["RECORD_DIR"])
-
-        for e in pygame.event.get():
+            for stride in scene.render_passes(frame):
+                screen.update()
+                screen.flip()
+                # Stop refining when the view is about to change
+                if input_pending():
+                    break
+            redraw = stride > 1
+            if not redraw and "RECORD_DIR" in os.environ:
+                screen.capture(os.environ["RECORD_DIR"], frame)
+        if HEADLESS and not redraw:
+            # There is no input to change the view
+            return
+
+        for e in poll_events():
             if e.type not in (KEYDOWN, MOUSEBUTTONDOWN):
                 continue
             if e.type == MOUSEBUTTONDOWN:
@@ -58,7 +100,7 @@ def main(argv):
                         step = 0.5
                     else:
                         step = 1.5
-                    scene.set_view(center = scene_coord, radius = scene.radius * step)
+                    scene.set_view(center = scene.convert_to_hp_plane(e.pos), radius = scene.radius * step)
                     redraw = True
                 else:
                     pids.add(subprocess.Popen(["./fractal_julia_set.py", str(scene_coord)]))
@@ -71,9 +113,13 @@ def main(argv):
                     elif e.key == K_RIGHT: step = +10/scene.scale[0]
                     elif e.key == K_DOWN:  step = complex(0, -10/scene.scale[1])
                     elif e.key == K_UP:    step = complex(0,  10/scene.scale[1])
-                    scene.set_view(center = scene.center + step)
+                    scene.move_center(step)
                 elif e.key == K_r:
                     scene.set_view(center = 0j, radius = 1.5)
+                elif e.key == K_m:
+                    scene.subdivide = not scene.subdivide
+                elif e.key == K_p:
+                    scene.progressive = not scene.progressive
                 else:
                     redraw = False
                     print
@@ -85,8 +131,6 @@ if __name__ == "__main__":
         main(sys.argv)
     except KeyboardInterrupt:
         pass
-    pool.terminate()
-    pool.join()
-    del pool
+    backend.terminate()
     for pid in pids:
         pid.terminate()
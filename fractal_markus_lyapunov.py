@@ -5,48 +5,56 @@
 from utils import *
 
 
-class MarkusLyapunov(Window, ComplexPlane):
+class MarkusLyapunov(Window, ComplexPlane, ProgressivePlane):
     def __init__(self, window_size, seed):
         Window.__init__(self, window_size)
-        self.seed = seed
         self.x0 = 0.5
         self.max_iter = 100 # 800
         self.max_init = 50 # 400
-        self.seed_values = seed * (int(max(self.max_iter, self.max_init) / float(len(self.seed))) + 1)
-        self.colorize = bright_color_factory(10)
+        self.set_seed(seed)
         #self.set_view(4+4j, 4)
         self.set_view(0j, 4)
 
+    def set_seed(self, seed):
+        self.seed = seed
+        self.seed_values = seed * (int(max(self.max_iter, self.max_init) / float(len(self.seed))) + 1)
+
+    def compute_pixels(self, pixels):
+        # Return the exponents of the pixels, or of the whole window when None
+        if pixels is None:
+            length = self.length
+        else:
+            length = len(pixels)
+            pixels = PixelList(pixels)
+        return compute(markus_lyapunov, [self.window_size, self.offset, self.scale, self.seed_values, self.x0, self.max_init, self.max_iter, pixels, length])
+
+    def colorize(self, exponents):
+        return bright_color_array(exponents, 10.)
+
     def render(self, frame):
         start_time = time.time()
-        for i in xrange(self.length):
-            x_pos, y_pos = i / self.window_size[1], i % self.window_size[1]
-            c = self.convert_to_plane((x_pos + 1, y_pos))
-            markus_func = lambda x: c.real if self.seed_values[idx] == "A" else c.imag
-
-            # Init
-            x = self.x0
-            for idx in xrange(1, self.max_init):
-                r = markus_func(idx)
-                x = r * x * ( 1 - x )
-
-            # Exponent
-            total = 0
-            for idx in range(1, self.max_iter):
-                r = markus_func(idx)
-                x = r * x * ( 1 - x )
-                v = abs(r - 2 * r * x)
-                if v == 0:
-                    v = 1e-6
-                total = total + math.log(v) / math.log(2)
-            exponent = total / float(self.max_iter)
-            if exponent == float('Inf'):
-                exponent = 0
-
-            self.draw_point((x_pos, y_pos), self.colorize(exponent))
-        print "%04d: %.2f sec: MarkusLyapunov(seed/center/radius = '%s' '%s' %s )" % (frame, time.time() - start_time, self.seed, self.center, self.radius)
+        self.blit(self.colorize(self.compute_pixels(None)))
+        self.log(frame, time.time() - start_time)
+
+    def draw_overlay(self):
+        pass
+
+    def rendered(self, frame, exponents, elapsed):
+        self.log(frame, elapsed)
+
+    def log(self, frame, elapsed):
+        print "%04d: %.2f sec: MarkusLyapunov(seed/center/radius = '%s' '%s' %s )" % (frame, elapsed, self.seed, self.center, self.radius)
 
 
+def set_argv_view(scene, argv):
+    # Frame definition of the command line: seed [center [radius]]
+    if len(argv) >= 1: scene.set_seed(argv[0])
+    if len(argv) >= 2: scene.set_view(center = complex(argv[1]))
+    if len(argv) >= 3: scene.set_view(radius = float(argv[2]))
+
+def new_scene(window_size):
+    return MarkusLyapunov(window_size, "AB")
+
 def main(argv):
     if len(argv) == 1:
         print "Markus-Lyapunov explorer"
@@ -54,26 +62,35 @@ def main(argv):
         print ""
         print "Click the window to center"
         print "Use keyboard arrow to move window, 'a'/'e' to zoom in/out, 'r' to reset view"
+        print "Use 'p' to toggle progressive rendering"
 
     pygame.init()
     screen = Screen(WINSIZE)
     clock = pygame.time.Clock()
 
-    scene = MarkusLyapunov(WINSIZE, "AB")
+    scene = new_scene(WINSIZE)
+    # Usage allow reuse of frame definition (seed, plane center, radius)
+    set_argv_view(scene, argv[1:])
     screen.add(scene)
     frame = 0
     redraw = True
     while True:
         if redraw:
             frame += 1
-            scene.render(frame)
-            screen.update()
-            pygame.display.update()
-            redraw = False
-            if "RECORD_DIR" in os.environ:
-                screen.capture(frame, os.environ["RECORD_DIR"])
-
-        for e in pygame.event.get():
+            for stride in scene.render_passes(frame):
+                screen.update()
+                screen.flip()
+                # Stop refining when the view is about to change
+                if input_pending():
+                    break
+            redraw = stride > 1
+            if not redraw and "RECORD_DIR" in os.environ:
+                screen.capture(os.environ["RECORD_DIR"], frame)
+        if HEADLESS and not redraw:
+            # There is no input to change the view
+            return
+
+        for e in poll_events():
             if e.type not in (KEYDOWN, MOUSEBUTTONDOWN):
                 continue
             if e.type == MOUSEBUTTONDOWN:
@@ -105,6 +122,8 @@ def main(argv):
                     scene.set_view(center = scene.center + step)
                 elif e.key == K_r:
                     scene.set_view(center = 4+4j, radius = 4)
+                elif e.key == K_p:
+                    scene.progressive = not scene.progressive
                 else:
                     redraw = False
                     continue
@@ -115,6 +134,4 @@ if __name__ == "__main__":
         main(sys.argv)
     except KeyboardInterrupt:
         pass
-    pool.terminate()
-    pool.join()
-    del pool
+    backend.terminate()
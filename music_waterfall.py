@@ -16,6 +16,7 @@ def main(argv):
     screen = Screen(WINSIZE)
 
     spectrogram = SpectroGram(audio_frame_size)
+    spectrogram.precompute(wav, audio_frames_path, argv[1], FPS)
     waterfall = Waterfall((WINSIZE[0] * 5 / 6., WINSIZE[1]), audio_frame_size)
     wavgraph = WavGraph((WINSIZE[0] / 6, WINSIZE[1]), audio_frame_size)
 
@@ -25,23 +26,23 @@ def main(argv):
     frame = 0
     if len(argv) == 3:
         frame = int(argv[2])
-    sound = pygame.mixer.Sound(array = wav[audio_frames_path[frame]:])
-    sound.play()
+    player = AudioPlayer(wav, audio_frames_path[frame])
+    player.play()
     pause = False
     clock = pygame.time.Clock()
     while True:
         start_time = time.time()
         if not pause:
             audio_buf = wav[audio_frames_path[frame]:audio_frames_path[frame]+audio_frame_size]
-            spectrogram.transform(audio_buf)
+            spectrogram.seek(frame)
 
             # Waterfall
             wavgraph.render(audio_buf)
             waterfall.render(spectrogram)
 
         screen.update()
-        pygame.display.update()
-        for e in pygame.event.get():
+        screen.flip()
+        for e in poll_events():
             if e.type not in (KEYDOWN, MOUSEBUTTONDOWN):
                 continue
             if e.type == MOUSEBUTTONDOWN:
@@ -59,6 +60,7 @@ def main(argv):
         elapsed = end_time - start_time
         if elapsed > 1 / (FPS * 1.2):
             print "Getting slow... %s" % elapsed
+        player.update()
         clock.tick(FPS)
         if not pause:
             frame += 1
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# Licensed under the Apache License, Version 2.0
+
+# Render lists of explorer views straight to files, without SDL, e.g.:
+#   echo "'(-0.64+0.5j)' 0j 1.5" | ./render_views.py julia /tmp/views
+# Each line holds the command line arguments of the explorer, the values
+# missing from a line are kept from the previous view.
+import os
+os.environ.setdefault("PYRENDER_HEADLESS", "1")
+import shlex
+from utils import *
+import fractal_julia_set, fractal_mandelbrot_set, fractal_markus_lyapunov
+
+explorers = {
+    "julia": fractal_julia_set,
+    "mandelbrot": fractal_mandelbrot_set,
+    "lyapunov": fractal_markus_lyapunov,
+}
+
+def main(argv):
+    parser = argparse.ArgumentParser(description = "Render views of an explorer to files")
+    parser.add_argument("explorer", choices = sorted(explorers))
+    parser.add_argument("dname", help = "output directory (RECORD_SINK=encoder writes dname/out.webm)")
+    parser.add_argument("views", nargs = "?", default = "-", help = "file with one view per line (default stdin)")
+    parser.add_argument("--start", type = int, default = 0, help = "number of the first frame")
+    args = parser.parse_args(argv[1:])
+
+    explorer = explorers[args.explorer]
+    if args.views == "-":
+        lines = sys.stdin.readlines()
+    else:
+        lines = open(args.views).readlines()
+
+    screen = Screen(WINSIZE)
+    scene = explorer.new_scene(WINSIZE)
+    screen.add(scene)
+    frame = args.start
+    for line in lines:
+        view = shlex.split(line, comments = True)
+        if not view:
+            continue
+        explorer.set_argv_view(scene, view)
+        scene.render(frame)
+        screen.update()
+        screen.capture(args.dname, frame)
+        frame += 1
+    if screen.sink is not None:
+        screen.sink.close()
+
+if __name__ == "__main__":
+    try:
+        main(sys.argv)
+    finally:
+        backend.terminate()
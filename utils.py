@@ -1,17 +1,21 @@
 #!/usr/bin/env python
 # Licensed under the Apache License, Version 2.0
 
-import argparse, cmath, math, os, time, colorsys, sys, random, signal
-import subprocess, multiprocessing
+import argparse, cmath, math, os, time, colorsys, sys, random, signal, decimal, hashlib
+START_TIME=time.time()
+import atexit, tempfile, itertools, threading, collections
+import subprocess, multiprocessing, multiprocessing.pool
 import pygame
 from pygame.locals import *
 import pygame.draw, pygame.image
 import numpy as np
-import scipy.io.wavfile
 
 # for headless rendering
 # export SDL_VIDEODRIVER=dummy
 # export SDL_AUDIODRIVER=dummy
+# or, to composite the frames with numpy only, without SDL
+# export PYRENDER_HEADLESS=1
+HEADLESS="PYRENDER_HEADLESS" in os.environ
 
 
 # Default window size constant
@@ -31,6 +35,20 @@ def hsv(h, s, v):
     r, g, b = colorsys.hsv_to_rgb(h, s, v)
     return int(b * 0xff) | int((g * 0xff)) << 8 | int(r * 0xff) << 16
 
+def hsv_array(h, s, v):
+    # Vectorized hsv, same as colorsys.hsv_to_rgb for s != 0
+    h = np.asarray(h, dtype=float)
+    i = np.trunc(h * 6.)
+    f = h * 6. - i
+    p, q, t = v * (1. - s), v * (1. - s * f), v * (1. - s * (1. - f))
+    i = i.astype(int) % 6
+    v = np.zeros(h.shape) + v
+    r = np.choose(i, (v, q, p, p, t, v))
+    g = np.choose(i, (t, v, v, q, p, p))
+    b = np.choose(i, (p, p, t, v, v, q))
+    rgb = (b * 0xff).astype(int) | (g * 0xff).astype(int) << 8 | (r * 0xff).astype(int) << 16
+    return rgb.astype('u4')
+
 def grayscale(r):
     return int(r * 0xff) | int((r * 0xff)) << 8 | int(r * 0xff) << 16
 
@@ -48,6 +66,12 @@ def bright_color_factory(scale, base_hue = 0.4):
         return hsv(base_hue + x / scale, 0.7, 0.7)
     return bright_color
 
+def bright_color_array(x, scale, base_hue = 0.4):
+    # Vectorized bright_color_factory, for non integer values
+    colors = hsv_array(base_hue + x / scale, 0.7, 0.7)
+    colors[x == scale] = 0
+    return colors
+
 def grayscale_color_factory(scale):
     def grayscale_color(x):
         if x == scale:
@@ -55,6 +79,21 @@ def grayscale_color_factory(scale):
         return grayscale(x / scale)
     return grayscale_color
 
+class Palette:
+    # Lookup table of a color factory indexed by iteration count
+    def __init__(self, color_factory):
+        self.color_factory = color_factory
+        self.args = None
+
+    def get(self, max_iter, *args):
+        # Only rebuild the table when max_iter or the factory args change
+        if (max_iter, args) != self.args:
+            color = self.color_factory(max_iter, *args)
+            size = int(math.ceil(max_iter)) + 1
+            self.colors = np.array(map(color, xrange(size)), dtype='u4')
+            self.args = (max_iter, args)
+        return self.colors
+
 
 # Basic maths
 MAX_SHORT=float((2 ** (2 * 8)) / 2)
@@ -63,62 +102,888 @@ def rotate_point(point, angle):
     return complex(point[0] * math.cos(angle) - point[1] * math.sin(angle),
                    point[0] * math.sin(angle) + point[1] * math.cos(angle))
 
+ESCAPE_LIMIT=1e150
+def pixels_to_plane(window_size, offset, scale, pixels):
+    # Vectorized ComplexPlane.convert_to_plane of flat pixel indices
+    x, y = pixels / window_size[1], pixels % window_size[1]
+    z = np.empty(len(pixels), dtype=np.complex128)
+    z.real = x / scale[0] + offset[0]
+    z.imag = (window_size[1] - y) / scale[1] + offset[1]
+    return z
+
+def interior_points(z):
+    # Return mask of the points inside the Mandelbrot set main cardioid
+    # or inside the period-2 bulb
+    x, y2 = z.real - 0.25, z.imag * z.imag
+    q = x * x + y2
+    inside = q * (q + x) < 0.25 * y2
+    inside |= (z.real + 1) ** 2 + y2 < 0.0625
+    return inside
+
+def escape_time(z, c, max_iter):
+    # Return iterations count before escape of every z points.
+    # All the still active points are iterated at once, escaped ones are
+    # removed from the working arrays as soon as they are recorded.
+    # Points found inside the set are given the count of the full loop
+    # without iterating it: Mandelbrot main cardioid and period-2 bulb are
+    # tested analytically, and orbits falling back on a previously saved
+    # value (Brent cycle detection) are periodic.
+    # c is None for the Mandelbrot set, or the Julia set constant, either a
+    # single one or one per point.
+    results = np.empty(len(z), dtype='i4')
+    interior = max(0, int(math.ceil(max_iter)))
+    if ENGINE == "numba":
+        if c is None:
+            jit_escape_time(z.real, z.imag, z.real, z.imag, False, float(max_iter), interior, results)
+        else:
+            c = np.broadcast_to(np.asarray(c, dtype=np.complex128), z.shape)
+            jit_escape_time(z.real, z.imag, c.real, c.imag, True, float(max_iter), interior, results)
+        return results
+    active = np.arange(len(z))
+    if c is None:
+        # Mandelbrot set
+        inside = interior_points(z)
+        results[inside] = interior
+        active = active[~inside]
+        u = np.zeros(len(active), dtype=np.complex128)
+        k = z[active]
+    else:
+        # Julia set
+        u = np.array(z, dtype=np.complex128)
+        k = c
+    saved, save_idx = None, 16
+    idx = 0
+    while idx < max_iter and len(active):
+        np.multiply(u, u, out=u)
+        u += k
+        done = np.abs(u.real) > ESCAPE_LIMIT
+        done |= np.abs(u.imag) > ESCAPE_LIMIT
+        update = done.any()
+        if update:
+            results[active[done]] = idx
+        if saved is not None and idx % 4 == 0:
+            periodic = u == saved
+            if periodic.any():
+                results[active[periodic]] = interior
+                done |= periodic
+                update = True
+        if update:
+            alive = ~done
+            active, u = active[alive], u[alive]
+            if saved is not None:
+                saved = saved[alive]
+            if np.ndim(k):
+                k = k[alive]
+        if idx == save_idx:
+            saved, save_idx = u.copy(), save_idx * 2
+        idx += 1
+    results[active] = idx
+    return results
+
 def complex_fractal(param):
     window_size, offset, scale, max_iter, c, step_size, chunk = param
     # Return numpy array of window pixel (step_size length, chunk position)
+    pixels = np.arange(chunk * step_size, (chunk + 1) * step_size)
+    return escape_time(pixels_to_plane(window_size, offset, scale, pixels), c, max_iter)
+
+def indexed_fractal(param):
+    window_size, offset, scale, max_iter, c, pixels, step_size, chunk = param
+    # Same as complex_fractal, for a list of flat pixel indices given as
+    # PixelList, so that pixels is the chunk slice
+    return escape_time(pixels_to_plane(window_size, offset, scale, pixels), c, max_iter)
+
+def batch_fractal(param):
+    window_size, c, center, radius, max_iter, step_size, chunk = param
+    # Same as complex_fractal for a block of Julia set frames, with one
+    # c, center, radius and max_iter per frame. Pixels are indexed by frame
+    # then by window pixel.
+    pixels = np.arange(chunk * step_size, (chunk + 1) * step_size)
+    frame_length = window_size[0] * window_size[1]
+    frames = np.minimum(pixels / frame_length, len(c) - 1)
+    pixels %= frame_length
+    radius, center = radius[frames], center[frames]
+    # Same scale as ComplexPlane.set_view
+    width = (center.real + radius) - (center.real - radius)
+    height = (center.imag + radius) - (center.imag - radius)
+    z = np.empty(len(pixels), dtype=np.complex128)
+    z.real = (pixels / window_size[1]) / (window_size[0] / width) + (center.real - radius)
+    z.imag = (window_size[1] - pixels % window_size[1]) / (window_size[1] / height) + (center.imag - radius)
+    results = np.empty(len(pixels), dtype='i4')
+    max_iter = max_iter[frames]
+    for frame_max_iter in np.unique(max_iter):
+        points = max_iter == frame_max_iter
+        results[points] = escape_time(z[points], c[frames][points], frame_max_iter)
+    return results
 
-    escape_limit = 1e150
-
-    results = np.zeros(step_size, dtype='i4')
-    #return results
-    pos = 0
-
-    while pos < step_size:
-        step_pos = pos + chunk * step_size
-        screen_coord = (step_pos / window_size[1], step_pos % window_size[1])
-        z = np.complex128(complex(
-            screen_coord[0] / scale[0] + offset[0],
-            ((window_size[1] - screen_coord[1]) / scale[1] + offset[1])
-        ))
-        if c is None:
-            # Mandelbrot set
-            u = 0
-        else:
-            # Julia set
-            u = z
-            z = c
-        idx = 0
-        while idx < max_iter:
-            u = u * u + z
-            if abs(u.real) > escape_limit or abs(u.imag) > escape_limit:
+def markus_lyapunov(param):
+    window_size, offset, scale, seed_values, x0, max_init, max_iter, pixels, step_size, chunk = param
+    # Return the Lyapunov exponent of the pixels, the r sequence alternates
+    # between the pixel coordinates according to the seed. pixels is None
+    # for the whole window, or the chunk slice of a PixelList
+    if pixels is None:
+        pixels = np.arange(chunk * step_size, (chunk + 1) * step_size)
+    c = pixels_to_plane(window_size, offset, scale, pixels + window_size[1])
+    if ENGINE == "numba":
+        exponent = np.empty(len(pixels))
+        seed_a = np.array(map(lambda x: x == "A", seed_values[:max(max_init, max_iter)]))
+        jit_markus_lyapunov(c.real, c.imag, seed_a, float(x0), max_init, max_iter, exponent)
+        return exponent
+    with np.errstate(all='ignore'):
+        # Init
+        x = np.zeros(len(pixels)) + x0
+        for idx in xrange(1, max_init):
+            r = c.real if seed_values[idx] == "A" else c.imag
+            x = r * x * (1 - x)
+
+        # Exponent
+        total = np.zeros(len(pixels))
+        for idx in xrange(1, max_iter):
+            r = c.real if seed_values[idx] == "A" else c.imag
+            x = r * x * (1 - x)
+            v = np.abs(r - 2 * r * x)
+            v[v == 0] = 1e-6
+            total += np.log(v) / math.log(2)
+        exponent = total / float(max_iter)
+    exponent[~np.isfinite(exponent)] = 0
+    return exponent
+
+# Optional numba engine, export COMPUTE_ENGINE=numpy|numba
+# The kernels are the scalar versions of the numpy ones, compiled on their
+# first call and cached on disk. numba only supports python 2 up to 0.47,
+# which gives the same results as numpy for every kernel, but it is an
+# extra dependency, so it stays opt-in.
+ENGINE=os.environ.get("COMPUTE_ENGINE", "numpy")
+if ENGINE == "numba":
+    try:
+        import numba
+    except ImportError:
+        ENGINE="numpy"
+
+if ENGINE == "numba":
+    @numba.njit(parallel=True, nogil=True, cache=True)
+    def jit_escape_time(zr, zi, cr, ci, julia, max_iter, interior, results):
+        for i in numba.prange(len(zr)):
+            x, y, kx, ky = zr[i], zi[i], cr[i], ci[i]
+            if not julia:
+                x = 0.
+                y = 0.
+                # Main cardioid and period-2 bulb
+                xq, y2 = kx - 0.25, ky * ky
+                q = xq * xq + y2
+                if q * (q + xq) < 0.25 * y2 or (kx + 1) * (kx + 1) + y2 < 0.0625:
+                    results[i] = interior
+                    continue
+            # numba 0.47 parfors fail on tuple assignments of constants
+            saved_x = 0.
+            saved_y = 0.
+            saved = False
+            save_idx = 16
+            idx = 0
+            count = -1
+            while idx < max_iter:
+                x, y = x * x - y * y + kx, x * y + y * x + ky
+                if abs(x) > ESCAPE_LIMIT or abs(y) > ESCAPE_LIMIT:
+                    count = idx
+                    break
+                if saved and idx % 4 == 0 and x == saved_x and y == saved_y:
+                    count = interior
+                    break
+                if idx == save_idx:
+                    saved_x, saved_y, saved, save_idx = x, y, True, save_idx * 2
+                idx += 1
+            if count == -1:
+                count = idx
+            results[i] = count
+
+    @numba.njit(parallel=True, nogil=True, cache=True)
+    def jit_markus_lyapunov(cr, ci, seed_a, x0, max_init, max_iter, exponent):
+        log2 = math.log(2)
+        for i in numba.prange(len(cr)):
+            x = x0
+            for idx in range(1, max_init):
+                r = cr[i] if seed_a[idx] else ci[i]
+                x = r * x * (1 - x)
+            total = 0.
+            for idx in range(1, max_iter):
+                r = cr[i] if seed_a[idx] else ci[i]
+                x = r * x * (1 - x)
+                v = abs(r - 2 * r * x)
+                if v == 0:
+                    v = 1e-6
+                total += math.log(v) / log2
+            value = total / max_iter
+            if math.isnan(value) or math.isinf(value):
+                value = 0.
+            exponent[i] = value
+
+# Mariani-Silver subdivision: tiles smaller than this are fully computed
+SUBDIVIDE_MIN=8
+# Window columns per compute() chunk, so that large rectangles can be filled
+SUBDIVIDE_COLUMNS=128
+def subdivide_fractal(param):
+    window_size, offset, scale, max_iter, c, step_size, chunk = param
+    # Same as complex_fractal, but only compute the border of rectangles and
+    # fill the ones with a single iteration count on their border.
+    start, stop = chunk * step_size, (chunk + 1) * step_size
+    columns = (start / window_size[1], (stop - 1) / window_size[1] + 1)
+    results = subdivide(window_size, offset, scale, max_iter, c, columns)
+    start -= columns[0] * window_size[1]
+    return results.flatten()[start:start + step_size]
+
+def subdivide(window_size, offset, scale, max_iter, c, columns):
+    # Return iterations count of the window columns range.
+    # Rectangles are processed level by level so that each level only needs
+    # a single escape_time call. Borders are inclusive and shared between
+    # the split rectangles.
+    height = window_size[1]
+    counts = np.zeros((columns[1] - columns[0], height), dtype='i4')
+    known = np.zeros(counts.shape, dtype=bool)
+    needed = np.zeros(counts.shape, dtype=bool)
+
+    def solve():
+        needed[known] = False
+        pixels = np.flatnonzero(needed)
+        if len(pixels):
+            z = pixels_to_plane(window_size, offset, scale, pixels + columns[0] * height)
+            counts.flat[pixels] = escape_time(z, c, max_iter)
+            known.flat[pixels] = True
+        needed[:] = False
+
+    def uniform(x0, y0, x1, y1):
+        value = counts[x0, y0]
+        return (counts[x0, y0:y1 + 1] == value).all() and \
+               (counts[x1, y0:y1 + 1] == value).all() and \
+               (counts[x0:x1 + 1, y0] == value).all() and \
+               (counts[x0:x1 + 1, y1] == value).all()
+
+    rects = [(0, 0, counts.shape[0] - 1, height - 1)]
+    while rects:
+        # Compute the border and the center of every rectangles at once, the
+        # center is either used to guard against thin filaments crossing the
+        # rectangle between the border pixels, or it is on the split border.
+        for x0, y0, x1, y1 in rects:
+            needed[(x0, x1), y0:y1 + 1] = True
+            needed[x0:x1 + 1, (y0, y1)] = True
+            needed[(x0 + x1) / 2, (y0 + y1) / 2] = True
+        solve()
+        split = []
+        for rect in rects:
+            x0, y0, x1, y1 = rect
+            if x1 - x0 < SUBDIVIDE_MIN or y1 - y0 < SUBDIVIDE_MIN:
+                # Small rectangles are computed with the next level
+                needed[x0 + 1:x1, y0 + 1:y1] = True
+            elif uniform(*rect) and counts[(x0 + x1) / 2, (y0 + y1) / 2] == counts[x0, y0]:
+                counts[x0 + 1:x1, y0 + 1:y1] = counts[x0, y0]
+                known[x0 + 1:x1, y0 + 1:y1] = True
+            else:
+                split.append(rect)
+        rects = []
+        for x0, y0, x1, y1 in split:
+            mx, my = (x0 + x1) / 2, (y0 + y1) / 2
+            rects.extend(((x0, y0, mx, my), (mx, y0, x1, my), (x0, my, mx, y1), (mx, my, x1, y1)))
+    solve()
+    return counts
+
+# Perturbation theory: pixels are computed as float64 delta to a high
+# precision reference orbit of the view center
+DEEP_ZOOM_RADIUS=1e-12
+SERIES_TOLERANCE=1e-12
+def reference_orbit(center, radius, max_iter):
+    # Return the orbit of the high precision center, up to its escape
+    orbit = [0j]
+    with decimal.localcontext(hp_context(radius)):
+        zr, zi = decimal.Decimal(0), decimal.Decimal(0)
+        for idx in xrange(int(math.ceil(max_iter))):
+            zr, zi = zr * zr - zi * zi + center[0], 2 * zr * zi + center[1]
+            orbit.append(complex(float(zr), float(zi)))
+            if abs(orbit[-1]) > 2:
                 break
-            idx += 1
-        results[pos] = idx
-        pos += 1
+    return np.array(orbit)
+
+def series_approximation(orbit, radius):
+    # Return the iteration count that can be skipped and the series
+    # coefficients so that delta = A * dc + B * dc**2 + C * dc**3
+    d = radius * math.sqrt(2)
+    a, b, c = 0j, 0j, 0j
+    # The coefficients give the delta at orbit[skip]
+    skip = 0
+    for idx in xrange(len(orbit) - 1):
+        z = orbit[idx]
+        na, nb, nc = 2 * z * a + 1, 2 * z * b + a * a, 2 * z * c + 2 * a * b
+        if abs(nc) * d ** 3 > SERIES_TOLERANCE * abs(na) * d:
+            break
+        a, b, c = na, nb, nc
+        skip = idx + 1
+    return skip, a, b, c
+
+def perturbation_fractal(param):
+    window_size, radius, scale, max_iter, orbit, series, step_size, chunk = param
+    # Same as complex_fractal for the Mandelbrot set, using the reference
+    # orbit of the view center. Glitches, when the pixel orbit gets closer to
+    # zero than to the reference, are rebased to the start of the reference.
+    pixels = np.arange(chunk * step_size, (chunk + 1) * step_size)
+    x, y = pixels / window_size[1], pixels % window_size[1]
+    dc = np.empty(len(pixels), dtype=np.complex128)
+    dc.real = x / scale[0] - radius
+    dc.imag = (window_size[1] - y) / scale[1] - radius
+
+    skip, a, b, c = series
+    results = np.empty(len(pixels), dtype='i4')
+    active = np.arange(len(pixels))
+    delta = ((c * dc + b) * dc + a) * dc
+    ref = np.zeros(len(pixels), dtype=int) + skip
+    last = len(orbit) - 1
+    if skip == last:
+        # The series reached the end of the reference
+        delta += orbit[last]
+        ref[:] = 0
+    idx = skip
+    while idx < max_iter and len(active):
+        delta *= 2 * orbit[ref] + delta
+        delta += dc
+        ref += 1
+        z = orbit[ref] + delta
+        done = np.abs(z.real) > ESCAPE_LIMIT
+        done |= np.abs(z.imag) > ESCAPE_LIMIT
+        if done.any():
+            results[active[done]] = idx
+            alive = ~done
+            active, delta, dc, ref, z = active[alive], delta[alive], dc[alive], ref[alive], z[alive]
+        rebase = (z.real ** 2 + z.imag ** 2) < (delta.real ** 2 + delta.imag ** 2)
+        rebase |= ref == last
+        if rebase.any():
+            delta[rebase] = z[rebase]
+            ref[rebase] = 0
+        idx += 1
+    results[active] = idx
     return results
 
+# Shared memory results
+if os.path.isdir("/dev/shm"):
+    SHARED_DIR="/dev/shm"
+else:
+    SHARED_DIR=tempfile.gettempdir()
+shared_maps = {}
+def shared_result(param):
+    # Same as method, but write the result in the shared array instead of returning it
+    path, dtype, capacity, method = param[:4]
+    step_size, chunk = param[-2:]
+    if path not in shared_maps:
+        # Forget the arrays that have been resized
+        for old_path in shared_maps.keys():
+            if not os.path.exists(old_path):
+                del shared_maps[old_path]
+        shared_maps[path] = np.memmap(path, dtype=dtype, mode='r+', shape=(capacity,))
+    res = method(param[4:])
+    shared_maps[path][chunk * step_size:chunk * step_size + len(res)] = res
+
+shared_paths = set()
+@atexit.register
+def remove_shared_arrays():
+    for path in list(shared_paths):
+        os.remove(path)
+    shared_paths.clear()
+
+class SharedArray:
+    # Result array backed by a shared memory file, reused across frames
+    count = 0
+    def __init__(self, dtype = 'i4'):
+        self.dtype = dtype
+        self.path = None
+        self.capacity = 0
+
+    def resize(self, capacity):
+        if capacity <= self.capacity:
+            return
+        self.close()
+        SharedArray.count += 1
+        self.path = os.path.join(SHARED_DIR, "pyrender-%d-%d" % (os.getpid(), SharedArray.count))
+        self.array = np.memmap(self.path, dtype=self.dtype, mode='w+', shape=(capacity,))
+        self.capacity = capacity
+        shared_paths.add(self.path)
+
+    def close(self):
+        if self.path is None:
+            return
+        del self.array
+        if self.path in shared_paths:
+            shared_paths.remove(self.path)
+            os.remove(self.path)
+        self.path = None
+        self.capacity = 0
+
+    def __del__(self):
+        self.close()
+
+def scheduled_task(param):
+    # Run a compute() chunk and return its index, worker, duration and result
+    start_time = time.time()
+    method, param = param[0], param[1:]
+    res = method(param)
+    worker = multiprocessing.current_process().name
+    if worker == "MainProcess":
+        worker = threading.current_thread().name
+    return param[-1], worker, time.time() - start_time, res
+
+class PixelList:
+    # compute() parameter given to each chunk as its own slice of the pixels
+    def __init__(self, pixels):
+        self.pixels = pixels
+
+def chunk_params(params, chunk, step_size):
+    return map(lambda x: x.pixels[chunk * step_size:(chunk + 1) * step_size] if isinstance(x, PixelList) else x, params)
+
+# Execution backends
+class SerialBackend:
+    def imap_unordered(self, method, tasks):
+        return itertools.imap(method, tasks)
+
+    def terminate(self):
+        pass
+
+def init_worker():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # pygame.init() handler of the parent would keep terminate() waiting
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # An encoder only gets the end of its stream once every writer is gone
+    for pipe in encoder_pipes:
+        pipe.close()
+
+class PoolBackend:
+    # The pool is only created on the first compute(). Process workers are
+    # forked, so they do not import anything (pygame included) and they
+    # inherit every function defined by then.
+    def __init__(self, pool_class, initializer = None):
+        self.pool_class = pool_class
+        self.initializer = initializer
+        self.pool = None
+
+    def imap_unordered(self, method, tasks):
+        if self.pool is None:
+            self.pool = self.pool_class(NUM_CPU, self.initializer)
+        return self.pool.imap_unordered(method, tasks)
+
+    def terminate(self):
+        if self.pool is None:
+            return
+        self.pool.terminate()
+        self.pool.join()
+        self.pool = None
+
+backends = {
+    "serial": SerialBackend(),
+    # For kernels releasing the GIL
+    "thread": PoolBackend(multiprocessing.pool.ThreadPool),
+    "process": PoolBackend(multiprocessing.Pool, init_worker),
+}
+# export COMPUTE_BACKEND=serial|thread|process
+if NUM_CPU > 1:
+    backend = backends[os.environ.get("COMPUTE_BACKEND", "process")]
+else:
+    backend = backends[os.environ.get("COMPUTE_BACKEND", "serial")]
+# Kernels that are a single numba call with the numba engine. They are
+# already parallel, so they run on the serial backend unless one is set.
+JIT_KERNELS = (complex_fractal, indexed_fractal, batch_fractal, markus_lyapunov)
+
+def set_backend(name):
+    global backend
+    if backends[name] is not backend:
+        backend.terminate()
+    backend = backends[name]
+
 # Multiprocessing abstraction
-pool = multiprocessing.Pool(NUM_CPU, lambda : signal.signal(signal.SIGINT, signal.SIG_IGN))
-def compute(method, params):
-    if pool:
-        params[-1] /= NUM_CPU
-        params = map(lambda x: params + [x], range(NUM_CPU))
-        # Compute
-        res = pool.map(method, params)
-        # Return flatten array
-        return np.array(res).flatten()
-    return method(params + [0])
+# Pixels per compute() chunk, chunks are handed out to the workers as they
+# become idle so that expensive areas do not keep a single worker busy
+COMPUTE_TILE=16384
+def compute(method, params, out = None, tile_size = COMPUTE_TILE):
+    # When out is a SharedArray, the result is a view of its array that is
+    # overwritten by the next compute using it
+    start_time = time.time()
+    length = params[-1]
+    step_size = max(1, min(tile_size, (length + NUM_CPU - 1) / NUM_CPU))
+    chunks = (length + step_size - 1) / step_size
+    params = params[:-1] + [step_size]
+    name = method.__name__
+    method_backend = backend
+    if ENGINE == "numba" and method in JIT_KERNELS and "COMPUTE_BACKEND" not in os.environ:
+        method_backend = backends["serial"]
+    if out is not None:
+        # Workers write straight into the shared array
+        out.resize(step_size * chunks)
+        params = [out.path, out.dtype, out.capacity, method] + params
+        method = shared_result
+    tasks = map(lambda x: [method] + chunk_params(params, x, step_size) + [x], xrange(chunks))
+    # Compute
+    res = [None] * chunks
+    busy = {}
+    for chunk, worker, elapsed, chunk_res in method_backend.imap_unordered(scheduled_task, tasks):
+        res[chunk] = chunk_res
+        busy[worker] = busy.get(worker, 0) + elapsed
+    if "COMPUTE_STATS" in os.environ:
+        elapsed = time.time() - start_time
+        print "compute: %s %d chunks in %.3f sec, utilization: %s" % (
+            name, chunks, elapsed,
+            ", ".join(map(lambda x: "%s %d%%" % (x, 100 * busy[x] / elapsed), sorted(busy))))
+    if out is not None:
+        return out.array[:length]
+    # Return flatten array
+    return np.concatenate(res)[:length]
+
+def compute_frames(window_size, frames, out = None):
+    # Return the iteration counts of a block of Julia set frames, given as
+    # (c, center, radius, max_iter) tuples, in a single compute
+    c, center, radius, max_iter = map(np.array, zip(*frames))
+    length = len(frames) * window_size[0] * window_size[1]
+    counts = compute(batch_fractal, [window_size, c.astype(np.complex128), center.astype(np.complex128), radius.astype(float), max_iter.astype(float), length], out)
+    return counts.reshape(len(frames), window_size[0], window_size[1])
+
+def compute_track(window_size, rows, out = None):
+    # Return the iteration counts of a block of track rows, subdivided frames
+    # are approximated one by one as EscapeTimePlane does
+    exact = ~rows["subdivide"]
+    if exact.all():
+        return compute_frames(window_size, zip(rows["c"], rows["center"], rows["radius"], rows["max_iter"]), out)
+    counts = np.empty((len(rows), window_size[0], window_size[1]), dtype='i4')
+    if exact.any():
+        exact_rows = rows[exact]
+        counts[exact] = compute_frames(window_size, zip(exact_rows["c"], exact_rows["center"], exact_rows["radius"], exact_rows["max_iter"]), out)
+    for idx in np.flatnonzero(~exact):
+        row = rows[idx]
+        center, radius = row["center"], row["radius"]
+        offset = (center.real - radius, center.imag - radius)
+        scale = (window_size[0] / float(center.real + radius - offset[0]),
+                 window_size[1] / float(center.imag + radius - offset[1]))
+        counts[idx] = compute(subdivide_fractal, [window_size, offset, scale, row["max_iter"], row["c"], window_size[0] * window_size[1]],
+                              None, SUBDIVIDE_COLUMNS * window_size[1]).reshape(window_size)
+    return counts
+
+# Scene parameters of every frame, so that any frame range can be rendered
+# without replaying the scenes
+TRACK_DTYPE=np.dtype([
+    ("frame", "i4"), ("c", "c16"), ("center", "c16"), ("radius", "f8"),
+    ("hue", "f8"), ("max_iter", "f8"), ("subdivide", "?"), ("scene", "S16"),
+])
+def save_track(fname, frames):
+    # frames are TRACK_DTYPE tuples
+    with open(fname, "wb") as f:
+        np.save(f, np.array(frames, dtype=TRACK_DTYPE))
+    print "%s: %d frames" % (fname, len(frames))
+
+def record_track_path(dname):
+    # Recordings first export the track of the scenes to dname, with a cheap
+    # parameter pass from the first frame since scenes are stateful. The
+    # track frames are then independent and rendered by render_track_frames()
+    if not os.path.isdir(dname):
+        os.makedirs(dname)
+    return os.path.join(dname, "track.npy")
+
+def load_track(fname):
+    return np.load(fname, mmap_mode='r')
+
+# Frame scheduler
+def frame_path(dname, frame):
+    return "%s/%04d.png" % (dname, frame)
+
+def pixels_rgb(pixels):
+    # rgb24 rows of a (width, height) array of 0xRRGGBB pixels
+    pixels = pixels.T
+    rgb = np.empty(pixels.shape + (3,), dtype='u1')
+    rgb[:, :, 0] = pixels >> 16
+    rgb[:, :, 1] = pixels >> 8
+    rgb[:, :, 2] = pixels
+    return rgb.tostring()
+
+def surface_rgb(surface):
+    if isinstance(surface, FrameBuffer):
+        return pixels_rgb(surface.pixels)
+    return pygame.image.tostring(surface, "RGB")
+
+def save_frame(fname, rgb, size):
+    # Write to a temporary file first, so that an existing frame is complete
+    tmp_fname = "%s.%d.png" % (fname[:-4], os.getpid())
+    pygame.image.save(pygame.image.fromstring(rgb, size, "RGB"), tmp_fname)
+    os.rename(tmp_fname, fname)
+
+# Frame sinks
+class PngSink:
+    # One png per frame, written in any order by any process
+    parallel = True
+
+    def __init__(self, dname):
+        self.dname = dname
+        if not os.path.isdir(dname):
+            os.makedirs(dname)
+
+    def done(self, frame):
+        return os.path.exists(frame_path(self.dname, frame))
+
+    def write(self, frame, surface):
+        self.write_rgb(frame, surface_rgb(surface), surface.get_size())
+
+    def write_rgb(self, frame, rgb, size):
+        save_frame(frame_path(self.dname, frame), rgb, size)
+
+    def close(self, audio = None, audio_start = 0.):
+        pass
+
+ENCODER = ["ffmpeg", "-y", "-loglevel", "error"]
+ENCODER_VIDEO = ["-c:v", "libvpx", "-threads", "4", "-b:v", "5M"]
+ENCODER_AUDIO = ["-c:a", "libvorbis"]
+# Pipes of the running encoders, closed in forked workers
+encoder_pipes = []
+class EncoderSink:
+    # Stream raw rgb frames, in order, to a long-lived encoder process.
+    # The audio is muxed at close, without re-encoding the video.
+    parallel = False
+
+    def __init__(self, fname, window_size, fps = 25):
+        self.fname = fname
+        self.video_fname = "%s.video%s" % os.path.splitext(fname)
+        dname = os.path.dirname(fname)
+        if dname and not os.path.isdir(dname):
+            os.makedirs(dname)
+        self.encoder = subprocess.Popen(ENCODER + [
+            "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", "%dx%d" % tuple(window_size),
+            "-framerate", "%d" % fps, "-i", "-"] + ENCODER_VIDEO + [self.video_fname],
+            stdin = subprocess.PIPE)
+        encoder_pipes.append(self.encoder.stdin)
+        atexit.register(self.close)
+
+    def done(self, frame):
+        return False
+
+    def write(self, frame, surface):
+        self.write_rgb(frame, surface_rgb(surface), surface.get_size())
+
+    def write_rgb(self, frame, rgb, size):
+        self.encoder.stdin.write(rgb)
+
+    def close(self, audio = None, audio_start = 0.):
+        # audio is a sound file muxed from audio_start seconds
+        if self.encoder is None:
+            return
+        encoder_pipes.remove(self.encoder.stdin)
+        self.encoder.stdin.close()
+        ret = self.encoder.wait()
+        self.encoder = None
+        if ret:
+            raise RuntimeError("%s: encoder failed (%d)" % (self.fname, ret))
+        if audio is None:
+            os.rename(self.video_fname, self.fname)
+            return
+        subprocess.check_call(ENCODER + [
+            "-i", self.video_fname, "-ss", "%.3f" % audio_start, "-i", audio,
+            "-c:v", "copy"] + ENCODER_AUDIO + ["-shortest", self.fname])
+        os.remove(self.video_fname)
+
+def frame_sink(dname, window_size, fps = 25, kind = None):
+    # RECORD_SINK=encoder streams the frames to dname/out.webm instead of pngs
+    if kind is None:
+        kind = os.environ.get("RECORD_SINK", "png")
+    if kind == "encoder":
+        return EncoderSink(os.path.join(dname, "out.webm"), window_size, fps)
+    return PngSink(dname)
+
+# Frames waiting to be written by an AsyncSink, and its writers
+CAPTURE_QUEUE = 8
+CAPTURE_WRITERS = 2
+def sink_task(param):
+    sink, frame, rgb, size = param
+    sink.write_rgb(frame, rgb, size)
+
+class AsyncSink:
+    # Write the frames of a sink in background threads, so that the render
+    # loop does not wait for png compression or the encoder. pygame releases
+    # the GIL while saving, and threads do not copy the frames through a
+    # pipe. Encoder frames go to a single thread to keep them in order.
+    # write() blocks while CAPTURE_QUEUE frames are pending, they are
+    # flushed at exit.
+    def __init__(self, sink, depth = CAPTURE_QUEUE, writers = CAPTURE_WRITERS):
+        self.sink = sink
+        self.depth = depth
+        if not sink.parallel:
+            writers = 1
+        self.pool = multiprocessing.pool.ThreadPool(writers)
+        self.pending = collections.deque()
+        atexit.register(self.close)
+
+    def done(self, frame):
+        return self.sink.done(frame)
+
+    def write(self, frame, surface):
+        while len(self.pending) >= self.depth:
+            # Raise the writer errors as well
+            self.pending.popleft().get()
+        self.pending.append(self.pool.apply_async(sink_task, [(
+            self.sink, frame, surface_rgb(surface), surface.get_size())]))
+
+    def close(self, audio = None, audio_start = 0.):
+        if self.pool is not None:
+            try:
+                while self.pending:
+                    self.pending.popleft().get()
+                self.pool.close()
+            finally:
+                self.pool.terminate()
+                self.pool.join()
+                self.pool = None
+        self.sink.close(audio, audio_start)
+
+def init_frame_worker():
+    global backend
+    init_worker()
+    # Each block of frames is computed on a single core
+    backend = backends["serial"]
+
+def frame_task(param):
+    render, sink, frames = param
+    start_time = time.time()
+    blocks = render(frames)
+    elapsed = (time.time() - start_time) / len(frames)
+    results = []
+    for frame, pixels in zip(frames, blocks):
+        if sink is not None:
+            sink.write_rgb(frame, pixels_rgb(pixels), pixels.shape)
+            pixels = None
+        results.append((frame, elapsed, pixels))
+    return results
+
+# Frames of a track rendered by a single compute when recording
+TRACK_BLOCK=24
+# Track, window size and palette of the frame scheduler workers
+scheduled_track = None
+def render_track_block(frames):
+    track, window_size, palette, palette_args = scheduled_track
+    rows = track[frames]
+    counts = compute_track(window_size, rows)
+    return map(lambda idx: palette.get(rows[idx]["max_iter"], rows[idx]["hue"], *palette_args)[counts[idx]],
+               xrange(len(rows)))
+
+def render_track_frames(track, window_size, palette, palette_args, frames, sink):
+    # Render frames of a track to the sink with the frame scheduler, the
+    # track rows are independent. The colors are palette.get(max_iter,
+    # hue, *palette_args).
+    global scheduled_track
+    scheduled_track = (track, window_size, palette, palette_args)
+    try:
+        schedule_frames(render_track_block, frames, sink, block = TRACK_BLOCK)
+    finally:
+        scheduled_track = None
+
+def schedule_frames(render, frames, sink, workers = NUM_CPU, block = 1):
+    # Render the frames with a pool of workers taking them block frames at a
+    # time. Frames already in the sink are skipped, so that an interrupted
+    # record can be resumed. render(frames) returns the pixels of a list of
+    # frames, it is called in forked workers so it can use the globals set
+    # before. Workers write to a parallel sink themselves, otherwise frames
+    # come back in order.
+    todo = filter(lambda x: not sink.done(x), frames)
+    print "%d frames to render, %d already done" % (len(todo), len(frames) - len(todo))
+    if not todo:
+        return
+    blocks = map(lambda x: todo[x:x + block], xrange(0, len(todo), block))
+    pool = multiprocessing.Pool(workers, init_frame_worker)
+    if sink.parallel:
+        results = pool.imap_unordered(frame_task, map(lambda x: (render, sink, x), blocks))
+    else:
+        results = pool.imap(frame_task, map(lambda x: (render, None, x), blocks))
+    start_time = time.time()
+    done, busy = 0, 0
+    try:
+        for block_results in results:
+            for frame, elapsed, pixels in block_results:
+                if pixels is not None:
+                    sink.write_rgb(frame, pixels_rgb(pixels), pixels.shape)
+                done += 1
+                busy += elapsed
+            fps = done / (time.time() - start_time)
+            sys.stdout.write("\r[%04d] %d/%d frames, %.2f fps (%.2f sec per frame), eta %d sec " % (
+                frame, done, len(todo), fps, busy / done, (len(todo) - done) / fps))
+            sys.stdout.flush()
+        print
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
 
 
 # scipyio abstraction
+class AudioSource:
+    # Memory mapped wav samples, with pad_start and pad_end frames of silence
+    # that are not stored. Slices within the file samples are views.
+    def __init__(self, wav_file, fps = 25, pad_start = 0, pad_end = 0):
+        import scipy.io.wavfile
+        self.freq, self.data = scipy.io.wavfile.read(wav_file, mmap = True)
+        self.frame_size = self.freq / fps
+        self.pad = pad_start * self.frame_size
+        self.length = self.pad + len(self.data) + pad_end * self.frame_size
+        self.channels = 1
+        if self.data.ndim > 1:
+            self.channels = self.data.shape[1]
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        start, stop, step = index.indices(self.length)
+        data_start, data_stop = start - self.pad, stop - self.pad
+        if 0 <= data_start <= data_stop <= len(self.data):
+            return self.data[data_start:data_stop]
+        # Partly in the padding
+        samples = np.zeros((max(0, stop - start),) + self.data.shape[1:], dtype=self.data.dtype)
+        low, high = max(0, data_start), min(len(self.data), data_stop)
+        if low < high:
+            samples[low - data_start:high - data_start] = self.data[low:high]
+        return samples
+
+    def write(self, fname, start = 0):
+        # Save the samples from start, a chunk at a time
+        if self.data.dtype.kind != 'i':
+            import scipy.io.wavfile
+            scipy.io.wavfile.write(fname, self.freq, self[start:])
+            return
+        import wave
+        out = wave.open(fname, "wb")
+        out.setnchannels(self.channels)
+        out.setsampwidth(self.data.dtype.itemsize)
+        out.setframerate(self.freq)
+        for pos in xrange(start, self.length, AUDIO_CHUNK * self.freq):
+            out.writeframes(self[pos:pos + AUDIO_CHUNK * self.freq].astype('<' + self.data.dtype.str[1:]).tostring())
+        out.close()
+
+# Seconds of samples given to the mixer at once
+AUDIO_CHUNK=2
+class AudioPlayer:
+    # Play a source from start, queueing the next chunk to the mixer channel
+    # while one is playing. update() needs to be called more often than
+    # every AUDIO_CHUNK seconds.
+    def __init__(self, source, start = 0):
+        self.source = source
+        self.pos = start
+        self.channel = None
+
+    def next_chunk(self):
+        size = AUDIO_CHUNK * self.source.freq
+        samples = np.ascontiguousarray(self.source[self.pos:self.pos + size])
+        self.pos += size
+        return pygame.mixer.Sound(array = samples)
+
+    def play(self):
+        self.channel = self.next_chunk().play()
+        self.update()
+
+    def update(self):
+        if self.channel is not None and self.pos < len(self.source) and self.channel.get_queue() is None:
+            self.channel.queue(self.next_chunk())
+
 def load_wav(wav_file, fps = 25, init_mixer = True):
-    freq, wav = scipy.io.wavfile.read(wav_file)
-    if freq % fps != 0:
-        raise RuntimeError("Can't load wav %d Hz at %d fps" % (freq, fps))
-    audio_frame_size = freq / fps
-    audio_frames_path = np.linspace(0, len(wav), int(len(wav) / freq * fps), endpoint=False)
+    wav = AudioSource(wav_file, fps)
+    if wav.freq % fps != 0:
+        raise RuntimeError("Can't load wav %d Hz at %d fps" % (wav.freq, fps))
+    audio_frame_size = wav.frame_size
+    audio_frames_path = np.linspace(0, len(wav), int(len(wav) / wav.freq * fps), endpoint=False).astype(int)
     if init_mixer:
-        pygame.mixer.init(frequency = freq, channels = len(wav[0]), buffer = audio_frame_size)
+        pygame.mixer.init(frequency = wav.freq, channels = wav.channels, buffer = audio_frame_size)
     return wav, audio_frame_size, audio_frames_path
 
 
@@ -131,6 +996,14 @@ class SpectroGram:
         self.fft_window = np.hanning(self.frame_size)
         self.inner_pad = np.zeros(self.frame_size)
         self.amps = {}
+        self.table = None
+
+    def precompute(self, wav, positions, wav_file, fps):
+        # Compute every frame at once, then seek(frame) replaces transform()
+        self.table = spectrogram_table(wav, positions, self.frame_size, wav_file, fps)
+
+    def seek(self, frame):
+        self.freq = self.table[frame]
 
     def transform(self, buf):
         self.buf = buf
@@ -146,67 +1019,162 @@ class SpectroGram:
             clipres = np.clip(dbres, -40, 200) * 1 / 196.
             self.freq = clipres + 0.204081632654
 
+def file_stamp(fname):
+    # Identify the file content by its path, size and modification time,
+    # without reading it
+    st = os.stat(fname)
+    return "%s %d %r" % (os.path.abspath(fname), st.st_size, st.st_mtime)
+
+# Frames transformed at once by spectrogram_table
+SPECTROGRAM_BLOCK=256
+def spectrogram_table(wav, positions, frame_size, wav_file, fps):
+    # SpectroGram.transform() of the frames of wav starting at positions, as
+    # a float32 array cached next to wav_file. The cache is keyed by the
+    # wav_file stamp, fps, frame_size and the positions (wav may be padded).
+    key = hashlib.sha1("%s %d %d %s" % (
+        file_stamp(wav_file), fps, frame_size,
+        hashlib.sha1(np.asarray(positions, dtype='i8').tostring()).hexdigest())).hexdigest()
+    fname = "%s.%s.spectrogram.npy" % (wav_file, key[:16])
+    if not os.path.isfile(fname):
+        start_time = time.time()
+        fft_window = np.hanning(frame_size)
+        tmp_fname = "%s.%d.npy" % (fname[:-4], os.getpid())
+        table = np.lib.format.open_memmap(tmp_fname, mode = 'w+', dtype = 'f4', shape = (len(positions), frame_size / 2))
+        for start in xrange(0, len(positions), SPECTROGRAM_BLOCK):
+            block = positions[start:start + SPECTROGRAM_BLOCK]
+            # Samples of the block, zero padded at the end of the wav
+            span = block[-1] + frame_size - block[0]
+            mono = np.zeros(span)
+            samples = np.mean(wav[block[0]:block[0] + span], axis=1)
+            mono[:len(samples)] = samples
+            # Overlapping view of every frame_size samples window
+            windows = np.lib.stride_tricks.as_strided(
+                mono, shape = (span - frame_size + 1, frame_size), strides = mono.strides * 2)
+            frames = windows[block - block[0]]
+            # Same as the fft of the window padded with frame_size zeros
+            spectrum = np.fft.rfft(fft_window * frames, 2 * frame_size)[:, :frame_size / 2] / frame_size
+            autopower = spectrum.real ** 2 + spectrum.imag ** 2
+            with np.errstate(divide = 'ignore'):
+                values = np.clip(20 * np.log10(autopower), -40, 200) * 1 / 196. + 0.204081632654
+            silent = (frames == 0).all(axis = 1)
+            values[silent] = autopower[silent]
+            table[start:start + len(frames)] = values
+        del table
+        os.rename(tmp_fname, fname)
+        print "%s: %d frames in %.2f sec" % (fname, len(positions), time.time() - start_time)
+    return np.load(fname, mmap_mode = 'r')
+
 # IIR filter abstraction (old way to extract low freq from audio file)
 class Filter:
     def __init__(self, bpass, bstop, ftype='butter'):
-        import scipy.signal.filter_design as fd
-        import scipy.signal.signaltools as st
-        self.b, self.a = fd.iirdesign(bpass, bstop, 1, 100, ftype=ftype, output='ba')
-        self.ic = st.lfiltic(self.b, self.a, (0.0,))
+        import scipy.signal
+        self.sos = scipy.signal.iirdesign(bpass, bstop, 1, 100, ftype=ftype, output='sos')
+        self.zi = np.zeros((len(self.sos), 2))
     def filter(self, data):
-        import scipy.signal.signaltools as st
-        res = st.lfilter(self.b, self.a, data, zi=self.ic)
-        self.ic = res[-1]
-        return res[0]
+        import scipy.signal
+        res, self.zi = scipy.signal.sosfilt(self.sos, data, zi=self.zi)
+        return res
+
+def wav_mono(filename):
+    # Samples of a pcm wav of any sample width, mixed down to mono in [-1; 1]
+    import wave
+    wav = wave.open(filename, "r")
+    width, channels = wav.getsampwidth(), wav.getnchannels()
+    buf = wav.readframes(wav.getnframes())
+    wav.close()
+    if width == 1:
+        # 8 bits samples are unsigned
+        w = (np.frombuffer(buf, np.uint8) - 128.) / 128.
+    elif width == 3:
+        # Shift the 24 bits samples to the high bytes of int32
+        raw = np.frombuffer(buf, np.uint8).reshape(-1, 3)
+        samples = np.zeros((len(raw), 4), dtype=np.uint8)
+        samples[:, 1:] = raw
+        w = samples.view('<i4')[:, 0] / float(2 ** 31)
+    else:
+        w = np.frombuffer(buf, '<i%d' % width) / float(2 ** (8 * width - 1))
+    return w.reshape(-1, channels).mean(axis=1)
+
+# Frames of envelope computed at once by envelope_follower
+ENVELOPE_BLOCK=256
+def envelope_follower(values, delay):
+    # Vectorized peak hold that decays by 1/delay of the distance to the value:
+    #   imp = v if v >= imp else imp - (imp - v) / delay
+    # The distance w = imp - v follows w_i = max(0, a * (w_i-1 + v_i-1 - v_i))
+    # with a = 1 - 1 / delay. Dividing w_i by a^i gives the Lindley recurrence
+    # u_i = max(0, u_i-1 + d_i), solved by u_k = S_k + max(u_0, -min(S_j<=k)).
+    values = np.asarray(values, dtype='f8')
+    if delay < 1:
+        # The decay would overshoot the value
+        raise RuntimeError("Can't follow an envelope with a delay of %s" % delay)
+    if delay == 1:
+        return np.array(values)
+    a = 1 - 1. / delay
+    # a^-block has to fit in a float
+    block = int(max(1, min(ENVELOPE_BLOCK, 600 / -np.log(a))))
+    diff = np.diff(np.append(0, values))
+    w = np.zeros(len(values))
+    prev = 0.
+    for start in xrange(0, len(values), block):
+        d = -diff[start:start + block]
+        scale = a ** np.arange(len(d))
+        s = np.cumsum(d / scale)
+        u = s + np.maximum(prev, -np.minimum.accumulate(s))
+        w[start:start + len(d)] = u * scale * a
+        prev = w[start + len(d) - 1]
+    return w + values
+
+def linear_recurrence(p, q, x = 0.):
+    # Vectorized x_i = p_i * x_i-1 + q_i, starting from x, for p_i in ]0; 1].
+    # Over a block x_k = P_k * (x + sum(q_j / P_j, j <= k)) with P_k the
+    # product of p_0..p_k, the block keeps 1 / P_k in a float.
+    p, q = np.asarray(p, dtype='f8'), np.asarray(q, dtype='f8')
+    out = np.zeros(len(q))
+    for start in xrange(0, len(q), ENVELOPE_BLOCK):
+        prod = np.cumprod(p[start:start + ENVELOPE_BLOCK])
+        out[start:start + len(prod)] = prod * (x + np.cumsum(q[start:start + len(prod)] / prod))
+        x = out[start + len(prod) - 1]
+    return out
 
 class AudioMod:
     def __init__(self, filename, frames, filter_type, delay = 10.0):
         self.frames = frames
         self.mod = np.zeros(frames)
-        self.cache_filename = "%s.mod" % filename
-        if not os.path.isfile(self.cache_filename):
-            if filter_type == 1:
-                self.fp = Filter(0.01, 0.1, ftype='ellip')
-            elif filter_type == 2:
-                self.fp = Filter((0.1, 0.2),  (0.05, 0.25), ftype='ellip')
-            if not os.path.isfile(filename):
+        self.fp = None
+        if filter_type == 1:
+            self.fp = Filter(0.01, 0.1, ftype='ellip')
+        elif filter_type == 2:
+            self.fp = Filter((0.1, 0.2),  (0.05, 0.25), ftype='ellip')
+        if not os.path.isfile(filename):
+            # Text cache of the peak values, kept for tracks shipped without their wav
+            legacy_filename = "%s.mod" % filename
+            if not os.path.isfile(legacy_filename):
                 print "Could not load %s" % filename
                 return
-            wave_values = self.load_wave(filename)
-            open(self.cache_filename, "w").write("\n".join(map(str, wave_values))+"\n")
-        else:
-            wave_values = map(float, open(self.cache_filename).readlines())
-        imp = 0.0
-        for i in xrange(0, self.frames):
-            if wave_values[i] >= imp:
-                imp = wave_values[i]
-            else:
-                delta = (imp - wave_values[i]) / delay
-                imp -= delta
-            self.mod[i] = imp
+            wave_values = np.loadtxt(legacy_filename)[:frames]
+            self.mod[:len(wave_values)] = envelope_follower(wave_values, delay)
+            return
+        # The cache is keyed by the wav stamp and the parameters
+        key = hashlib.sha1("%s %d %d %r" % (file_stamp(filename), frames, filter_type, delay)).hexdigest()
+        self.cache_filename = "%s.%s.mod.npy" % (filename, key[:16])
+        if not os.path.isfile(self.cache_filename):
+            tmp_fname = "%s.%d.npy" % (self.cache_filename[:-4], os.getpid())
+            np.save(tmp_fname, envelope_follower(self.load_wave(filename), delay))
+            os.rename(tmp_fname, self.cache_filename)
+        self.mod = np.load(self.cache_filename, mmap_mode = 'r')
 
     def load_wave(self, filename):
-        import wave
-        wav = wave.open(filename, "r")
-        if wav.getsampwidth() != 2 or wav.getnchannels() != 1:
-            print "Only support mono 16bit encoding..."
-            exit(1)
-
-        # Read all frames
-        buf = wav.readframes(wav.getnframes())
-
-        # Convert to float array [-1; 1]
-        w = np.fromstring(buf, np.int16) / float((2 ** (2 * 8)) / 2)
-
-        step = wav.getnframes() / self.frames + 1
-        wave_values = []
-        for i in xrange(0, wav.getnframes(), step):
-            wf = w[i:i+step]
-            if self.fp:
-                wf = self.fp.filter(wf)
-
-            v = np.max(np.abs(wf))
-            wave_values.append(float(v))
+        w = wav_mono(filename)
+        if self.fp:
+            w = self.fp.filter(w)
+
+        # Peak of each step samples, the frames past the end of the wav are silent
+        step = len(w) / self.frames + 1
+        count = min(self.frames, (len(w) + step - 1) / step)
+        peaks = np.zeros((count, step))
+        peaks.flat[:min(len(w), count * step)] = np.abs(w[:count * step])
+        wave_values = np.zeros(self.frames)
+        wave_values[:count] = peaks.max(axis=1)
         return wave_values
 
     def plot(self):
@@ -222,41 +1190,191 @@ class AudioMod:
 
 
 
+# Numpy abstraction of the pygame surfaces used in headless mode
+def color_value(color):
+    if isinstance(color, (int, long, np.integer)):
+        return color
+    return int(color[0]) << 16 | int(color[1]) << 8 | int(color[2])
+
+class FrameBuffer:
+    def __init__(self, size):
+        self.pixels = np.zeros(map(int, size), dtype='u4')
+
+    def get_size(self):
+        return self.pixels.shape
+
+    def fill(self, color = [0]*3):
+        self.pixels.fill(color_value(color))
+
+    def set_at(self, coord, color):
+        if 0 <= coord[0] < self.pixels.shape[0] and 0 <= coord[1] < self.pixels.shape[1]:
+            self.pixels[coord[0], coord[1]] = color_value(color)
+
+    def draw_line(self, color, start_coord, end_coord):
+        length = max(abs(end_coord[0] - start_coord[0]), abs(end_coord[1] - start_coord[1])) + 1
+        x = np.rint(np.linspace(start_coord[0], end_coord[0], length)).astype(int)
+        y = np.rint(np.linspace(start_coord[1], end_coord[1], length)).astype(int)
+        inside = (x >= 0) & (x < self.pixels.shape[0]) & (y >= 0) & (y < self.pixels.shape[1])
+        self.pixels[x[inside], y[inside]] = color_value(color)
+
+    def blit_array(self, nparray):
+        self.pixels[:] = nparray
+
+    def blit(self, source, coord, area = None):
+        # Composite by slicing, clipped to the frame buffer
+        x, y = coord[0], coord[1]
+        if area is None:
+            area = (0, 0) + source.get_size()
+        sx, sy, width, height = area
+        width = min(width, self.pixels.shape[0] - x)
+        height = min(height, self.pixels.shape[1] - y)
+        if width > 0 and height > 0:
+            self.pixels[x:x + width, y:y + height] = source.pixels[sx:sx + width, sy:sy + height]
+
+def new_surface(size):
+    if HEADLESS:
+        return FrameBuffer(size)
+    return pygame.Surface(size)
+
+def blit_array(surface, nparray, rect = None):
+    # Only copy the rect area of nparray when given
+    if rect is not None:
+        x, y, width, height = rect
+        nparray = nparray[x:x + width, y:y + height]
+        if HEADLESS:
+            surface.pixels[x:x + width, y:y + height] = nparray
+            return
+        surface = surface.subsurface(rect)
+    if HEADLESS:
+        surface.blit_array(nparray)
+    else:
+        pygame.surfarray.blit_array(surface, nparray)
+
+def blit_array_at(surface, nparray, coord):
+    # Copy nparray to the area of surface starting at coord
+    x, y = coord
+    width, height = nparray.shape
+    if HEADLESS:
+        surface.pixels[x:x + width, y:y + height] = nparray
+    else:
+        pygame.surfarray.blit_array(surface.subsurface((x, y, width, height)), nparray)
+
+def new_font():
+    # There is no text in headless mode
+    if HEADLESS:
+        return None
+    return pygame.font.SysFont(u'dejavusansmono', 18)
+
+def poll_events():
+    # There is no input in headless mode, where SDL is not initialized
+    if HEADLESS:
+        return []
+    return pygame.event.get()
+
+def input_pending():
+    # A key or a click is waiting, e.g. to stop refining a view
+    if HEADLESS:
+        return False
+    return pygame.event.peek((KEYDOWN, MOUSEBUTTONDOWN))
+
 # Pygame abstraction
 class Screen:
     def __init__(self, screen_size):
-        pygame.init()
-        self.font = pygame.font.SysFont(u'dejavusansmono', 18)
-        self.screen = pygame.display.set_mode(screen_size)
+        if HEADLESS:
+            self.screen = FrameBuffer(screen_size)
+        else:
+            pygame.init()
+            self.screen = pygame.display.set_mode(screen_size)
+        self.font = new_font()
         self.windows = []
+        self.started = False
+        self.sink = None
+        # Screen areas changed by the last update(), and drawn over windows
+        self.damage = []
+        self.overlays = []
+        # Bytes composited by the last update(), and since the start
+        self.uploaded = 0
+        self.total_uploaded = 0
 
     def draw_msg(self, msg, coord = (5, 5), color = (180, 180, 255)):
+        if self.font is None:
+            return
         text = self.font.render(msg, True, color)
-        self.screen.blit(text, coord)
+        rect = self.screen.blit(text, coord)
+        self.damage.append(rect)
+        self.overlays.append(rect)
 
     def capture(self, dname, frame):
-        if not os.path.isdir(dname):
-            os.mkdir(dname)
-        fname = "%s/%04d.png" % (dname, frame)
-        try:
-            pygame.image.save(self.screen, fname)
-        except Exception, e:
-            print fname, e
-            raise
+        if self.sink is None:
+            self.sink = AsyncSink(frame_sink(dname, self.screen.get_size()))
+        self.sink.write(frame, self.screen)
 
     def add(self, window, coord = (0, 0)):
         self.windows.append((window, coord))
+        window.invalidate()
 
     def update(self):
+        # Composite the damaged areas of the windows, and return them as
+        # screen rects
+        self.damage = []
+        self.uploaded = 0
         for window, coord in self.windows:
+            window_rect = pygame.Rect(coord, window.window_size)
+            for overlay in self.overlays:
+                # Restore what the last messages were drawn over
+                if window_rect.colliderect(overlay):
+                    window.invalidate(overlay.clip(window_rect).move(-coord[0], -coord[1]))
+            if window.pixels is not None and window.pixels is not window.uploaded:
+                window.invalidate()
+            if not window.dirty:
+                continue
+            rect = window.damage
             if window.pixels is not None:
-                pygame.surfarray.blit_array(window.surface, window.pixels)
-            self.screen.blit(window.surface, coord)
+                blit_array(window.surface, window.pixels, rect)
+                window.uploaded = window.pixels
+            self.screen.blit(window.surface, rect.move(coord), rect)
+            self.damage.append(rect.move(coord))
+            self.uploaded += 4 * rect.width * rect.height
+            window.dirty = False
+        self.overlays = []
+        self.total_uploaded += self.uploaded
+        if "SCREEN_STATS" in os.environ:
+            print "screen: %d rects, %d KB uploaded (%d KB total)" % (
+                len(self.damage), self.uploaded / 1024, self.total_uploaded / 1024)
+        if not self.started:
+            self.started = True
+            print "Startup: %.3f sec to first frame" % (time.time() - START_TIME)
+        return self.damage
+
+    def flip(self):
+        # Show the areas changed since the last update()
+        if not HEADLESS:
+            pygame.display.update(self.damage)
+
+class Damage:
+    # Dirty flag and damage rect of a part of the screen
+    dirty = False
+    uploaded = None
+
+    def invalidate(self, rect = None):
+        # Composite the rect of the part again, or all of it when None
+        window_rect = pygame.Rect((0, 0), self.window_size)
+        if rect is None:
+            rect = window_rect
+        else:
+            rect = pygame.Rect(rect).clip(window_rect)
+        if not rect.width or not rect.height:
+            return
+        if self.dirty:
+            self.damage.union_ip(rect)
+        else:
+            self.damage = rect
+            self.dirty = True
 
-class ScreenPart:
+class ScreenPart(Damage):
     def __init__(self, window_size):
         try:
-            self.surface = pygame.Surface(window_size)
+            self.surface = new_surface(window_size)
             self.window_size = map(int, window_size)
             self.length = self.window_size[0] * self.window_size[1]
             self.pixels = np.zeros(self.length, dtype='i4').reshape(*self.window_size)
@@ -265,75 +1383,483 @@ class ScreenPart:
             raise
 
     def blit(self, nparray):
-        pygame.surfarray.blit_array(self.surface, nparray.reshape(*self.window_size))
+        blit_array(self.surface, nparray.reshape(*self.window_size))
+        self.invalidate()
 
 # Ready to use 'widget'
 class WavGraph(ScreenPart):
-    def __init__(self, window_size, frame_size):
+    # Each row shows the samples of a block of the frame, in three lanes.
+    # By default the lanes are the first two mono samples and the mono
+    # mean of the block; with envelope, the min and max of the left, right
+    # and mono samples of the block.
+    def __init__(self, window_size, frame_size, envelope = False):
         ScreenPart.__init__(self, window_size)
         self.frame_size = frame_size
         self.wav_step = self.frame_size / self.window_size[1]
         self.x_range = self.window_size[0] / 2
+        self.envelope = envelope
+        offsets = np.array((-self.x_range / 2, self.x_range / 2, 0))
+        colors = np.array((0xf10000, 0x00f100, 0xf1), dtype='i4')
+        if envelope:
+            offsets, colors = np.tile(offsets, 2), np.tile(colors, 2)
+        self.offsets = self.x_range + offsets[:, np.newaxis]
+        self.colors = np.repeat(colors, self.window_size[1])
+        self.rows = np.tile(np.arange(self.window_size[1]), len(colors))
+        self.points = None
 
     def render(self, buf):
-        # Wav graph
-        pixels = np.zeros(self.length, dtype='i4').reshape(*self.window_size)
-        for y in xrange(0, self.window_size[1]):
-            mbuf = np.mean(buf[y * self.wav_step:(y + 1) * self.wav_step], axis=1)
-            left = mbuf[0]
-            right = mbuf[1]
-            mono = np.mean(mbuf)
-            for point, offset, color in ((left, -self.x_range / 2, 0xf10000), (right, self.x_range / 2, 0x00f100), (mono, 0, 0xf1)):
-                pixels[int(self.x_range + offset + (self.x_range / 2.) * point / MAX_SHORT)][y] = color
-        self.pixels = pixels
+        height = self.window_size[1]
+        blocks = buf[:height * self.wav_step]
+        if len(blocks) < height * self.wav_step:
+            blocks = np.concatenate((blocks, np.zeros((height * self.wav_step - len(blocks), 2), dtype=buf.dtype)))
+        blocks = blocks.reshape(height, self.wav_step, 2).astype(float)
+        if self.envelope:
+            samples = np.concatenate((blocks, np.mean(blocks, axis=2)[:, :, np.newaxis]), axis=2)
+            points = np.concatenate((np.min(samples, axis=1).T, np.max(samples, axis=1).T))
+        else:
+            mono = np.mean(blocks, axis=2)
+            points = np.array((mono[:, 0], mono[:, 1], np.mean(mono, axis=1)))
+        x = (self.offsets + (self.x_range / 2.) * points / MAX_SHORT).astype(int)
+        # Clear the previous points, the later lanes are drawn over the others
+        if self.points is not None:
+            self.pixels[self.points] = 0
+        self.points = (x.ravel(), self.rows)
+        self.pixels[self.points] = self.colors
+        self.invalidate()
+
+# Spectrogram values are within [0, WATERFALL_MAX]
+WATERFALL_MAX=1.25
+WATERFALL_COLORS=4096
+def mel(hz):
+    return 2595. * np.log10(1. + hz / 700.)
+
+def mel_hz(mel):
+    return 700. * (10 ** (mel / 2595.) - 1.)
 
 class Waterfall(ScreenPart):
-    def __init__(self, window_size, frame_size, width = 1):
+    # Columns are written in a ring buffer, one per frame, and the surface
+    # is drawn from the oldest column. Rows are the mean of a range of
+    # spectrogram bins, linearly spaced by width bins, or log or mel spaced
+    # over the whole spectrum.
+    def __init__(self, window_size, frame_size, width = 1, spacing = "linear", fps = 25):
         ScreenPart.__init__(self, window_size)
         self.frame_size = frame_size
         self.width = width
-
-    def render(self, spectrogram):
-        self.pixels = np.roll(self.pixels, -1, axis=0)
-        for y in xrange(self.window_size[1] - 1, 0, -1):
-            inv_y = self.window_size[1] - y
+        self.pixels = None
+        self.ring = np.zeros(self.window_size, dtype='u4')
+        self.pos = 0
+        point = np.linspace(0, WATERFALL_MAX, WATERFALL_COLORS)
+        self.colors = hsv_array(0.5 + 0.3 * point, 0.3 + 0.6 * point, 0.2 + 0.8 * point)
+        self.bins = self.bins_matrix(frame_size / 2, spacing, fps)
+
+    def bins_matrix(self, bins, spacing, fps):
+        # Sparse matrix of the bins mean of each row, the bottom row is bin 1
+        import scipy.sparse
+        height = self.window_size[1]
+        inv_y = np.arange(height, 0, -1)
+        if spacing == "linear":
+            low = (inv_y * self.width).astype(int)
+            high = ((inv_y + 1) * self.width).astype(int)
+            self.active = (inv_y < height) & ((inv_y + 1) * self.width < bins)
             if self.width == 1:
-                point = spectrogram.freq[inv_y]
+                self.active = (inv_y < height) & (inv_y < bins)
+        else:
+            # Edges from bin 1 to the last bin, spaced in log or mel scale
+            steps = np.linspace(0, 1, height)
+            if spacing == "log":
+                edges = bins ** steps
+            elif spacing == "mel":
+                # The fft of 2 * frame_size samples, at frame_size * fps Hz
+                hz = fps / 2.
+                edges = mel_hz(mel(hz) + steps * (mel(hz * bins) - mel(hz))) / hz
             else:
-                if (inv_y + 1) * self.width >= len(spectrogram.freq):
-                    break
-                point = np.mean(spectrogram.freq[int(inv_y * self.width):int((inv_y + 1) * self.width)])
-            self.pixels[-1][y] = hsv(0.5 + 0.3 * point, 0.3 + 0.6 * point, 0.2 + 0.8 * point)
+                raise RuntimeError("Unknown waterfall spacing %s" % spacing)
+            low = np.minimum(edges[inv_y - 1], bins - 1).astype(int)
+            high = np.append(edges, bins)[inv_y].astype(int)
+            self.active = inv_y < height
+        high = np.maximum(high, low + 1)
+        count = np.where(self.active, high - low, 0)
+        rows = np.repeat(np.arange(height), count)
+        cols = np.concatenate(map(lambda x: np.arange(x[0], x[0] + x[1]), zip(low, count)))
+        return scipy.sparse.csr_matrix(
+            (1. / np.repeat(count, count), (rows, cols.astype(int))), shape = (height, bins))
+
+    def render(self, spectrogram):
+        values = self.bins.dot(spectrogram.freq)
+        index = np.clip(np.rint(values * ((WATERFALL_COLORS - 1) / WATERFALL_MAX)), 0, WATERFALL_COLORS - 1)
+        self.ring[self.pos] = np.where(self.active, self.colors[index.astype(int)], 0)
+        self.pos = (self.pos + 1) % self.window_size[0]
+        # Oldest column on the left
+        blit_array_at(self.surface, self.ring[self.pos:], (0, 0))
+        if self.pos:
+            blit_array_at(self.surface, self.ring[:self.pos], (self.window_size[0] - self.pos, 0))
+        self.invalidate()
 
 
 # Legacy abstraction
-class Window:
+class Window(Damage):
     def __init__(self, window_size):
-        self.surface = pygame.Surface(window_size)
-        self.font = pygame.font.SysFont(u'dejavusansmono', 18)
+        self.surface = new_surface(window_size)
+        self.font = new_font()
         self.window_size = window_size
         self.length = window_size[0] * window_size[1]
         self.pixels = None
 
     def fill(self, color = [0]*3):
         self.surface.fill(color)
+        self.invalidate()
 
     def draw_msg(self, msg, coord = (5, 5), color = (180, 180, 255)):
+        if self.font is None:
+            return
         text = self.font.render(msg, True, color)
-        self.surface.blit(text, coord)
+        self.invalidate(self.surface.blit(text, coord))
 
     def draw_line(self, start_coord, end_coord, color = (28,28,28)):
-        pygame.draw.line(self.surface, color, start_coord, end_coord)
+        if HEADLESS:
+            self.surface.draw_line(color, start_coord, end_coord)
+        else:
+            pygame.draw.line(self.surface, color, start_coord, end_coord)
+        x = min(start_coord[0], end_coord[0])
+        y = min(start_coord[1], end_coord[1])
+        self.invalidate((x, y, abs(end_coord[0] - start_coord[0]) + 1, abs(end_coord[1] - start_coord[1]) + 1))
 
     def draw_point(self, coord, color = [242]*3):
         self.surface.set_at(coord, color)
+        self.invalidate((coord[0], coord[1], 1, 1))
 
     def blit(self, nparray):
-        pygame.surfarray.blit_array(self.surface, nparray.reshape(*self.window_size))
+        blit_array(self.surface, nparray.reshape(*self.window_size))
+        self.invalidate()
+
+# Arbitrary precision complex, as a (real, imag) tuple of Decimal
+def hp_context(radius):
+    # Keep enough digits to address every pixel of the view
+    return decimal.Context(prec = max(28, 24 - int(math.log10(radius))))
+
+def hp_complex(value):
+    if isinstance(value, tuple):
+        return value
+    if not isinstance(value, basestring):
+        value = complex(value)
+        return (decimal.Decimal(value.real), decimal.Decimal(value.imag))
+    # Parse complex string without losing precision, e.g. '(-0.7436438870371587+0.1318259042053119j)'
+    value = value.strip().strip("()").replace(" ", "")
+    if not value.endswith("j"):
+        return (decimal.Decimal(value), decimal.Decimal(0))
+    value = value[:-1]
+    split = max(value.rfind("+"), value.rfind("-"))
+    while split > 0 and value[split - 1] in "eE":
+        split = max(value.rfind("+", 0, split - 1), value.rfind("-", 0, split - 1))
+    if split <= 0:
+        return (decimal.Decimal(0), decimal.Decimal(value or "1"))
+    imag = value[split:]
+    if imag in ("+", "-"):
+        imag += "1"
+    return (decimal.Decimal(value[:split]), decimal.Decimal(imag))
+
+def hp_add(value, step, radius):
+    step = hp_complex(step)
+    with decimal.localcontext(hp_context(radius)):
+        return (value[0] + step[0], value[1] + step[1])
+
+def hp_str(value):
+    return "(%s%s%sj)" % (value[0], "+" if value[1] >= 0 else "", value[1])
+
+# Progressive rendering, the first pass computes one pixel every
+# PROGRESSIVE_STRIDE in both directions and each next pass halves the stride
+PROGRESSIVE_STRIDE=8
+def interlaced_pixels(window_size, stride):
+    # Return the flat pixel indices of the pass that are not already known
+    x = np.arange(0, window_size[0], stride)[:, np.newaxis]
+    y = np.arange(0, window_size[1], stride)
+    pixels = x * window_size[1] + y
+    if stride == PROGRESSIVE_STRIDE:
+        return pixels.flatten()
+    return pixels[(x % (2 * stride) != 0) | (y % (2 * stride) != 0)]
+
+class ProgressivePlane:
+    # Scene mixin for Window implementing compute_pixels(pixels) that returns
+    # values, colorize(values), draw_overlay() and rendered(frame, values, elapsed).
+    # Scenes may also implement prefill() to return already known values
+    # and their mask.
+    progressive = True
+
+    def interlaced(self):
+        return self.progressive
+
+    def prefill(self):
+        return None, None
+
+    def render_passes(self, frame):
+        # Render the frame, yielding after each pass
+        if not self.interlaced():
+            self.render(frame)
+            yield 1
+            return
+        start_time = time.time()
+        values, known = self.prefill()
+        colors = np.zeros(self.window_size, dtype='u4')
+        stride = PROGRESSIVE_STRIDE
+        while stride:
+            pixels = interlaced_pixels(self.window_size, stride)
+            missing = pixels
+            if known is not None:
+                missing = pixels[~known.flat[pixels]]
+            if len(missing):
+                missing_values = self.compute_pixels(missing)
+                if values is None:
+                    values = np.zeros(self.window_size, dtype=missing_values.dtype)
+                values.flat[missing] = missing_values
+            colors.flat[pixels] = self.colorize(values.flat[pixels])
+            # Unknown pixels use the value of their top-left computed pixel
+            x = np.arange(self.window_size[0]) / stride * stride
+            y = np.arange(self.window_size[1]) / stride * stride
+            self.blit(colors[x][:, y])
+            self.draw_overlay()
+            yield stride
+            stride /= 2
+        self.rendered(frame, values, time.time() - start_time)
+
+# On-disk cache of iteration counts tiles, e.g.
+# export PYRENDER_CACHE=~/.cache/pyrender
+# export PYRENDER_CACHE_SIZE=512 # MB
+TILE_SIZE=64
+class TileCache:
+    # Tiles are .npy files of TILE_SIZE pixels squares on a grid aligned on
+    # the plane origin, keyed by the fractal kind, c, max_iter, the scale, the
+    # sub-pixel phase of the grid and the tile position, so that they are
+    # found again after a pan. The least recently used tiles are removed when
+    # the cache grows over max_size bytes.
+    def __init__(self, path, max_size):
+        self.path = os.path.expanduser(path)
+        self.max_size = max_size
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.size = sum(map(lambda x: x[1], self.tiles()))
+
+    def tiles(self):
+        # Return (mtime, size, path) of the tiles
+        tiles = []
+        for name in os.listdir(self.path):
+            if not name.endswith(".npy"):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            tiles.append((st.st_mtime, st.st_size, path))
+        return tiles
+
+    def grid(self, view):
+        # Return the grid pixel of the view top-left pixel and the grid phase,
+        # in 1/1024th of pixel. Grid rows go down like the screen ones.
+        window_size, offset, scale = view[:3]
+        origin, phase = [], []
+        for pos in (offset[0] * scale[0], -offset[1] * scale[1] - window_size[1]):
+            pos = int(round(pos * 1024))
+            origin.append(pos // 1024)
+            phase.append(pos % 1024)
+        return origin, phase
+
+    def tile_path(self, view, phase, tx, ty):
+        window_size, offset, scale, max_iter, c = view
+        if c is None:
+            kind = "mandelbrot"
+        else:
+            kind = "julia"
+        key = "%s %r %r %.15g %.15g %d %d %d %d %d" % (
+            kind, c, max_iter, scale[0], scale[1], phase[0], phase[1], tx, ty, TILE_SIZE)
+        return os.path.join(self.path, "%s.npy" % hashlib.sha1(key).hexdigest())
+
+    def view_tiles(self, view):
+        # Yield the view area, the tile area, whether the tile is entirely
+        # in the view, and the path of the grid tiles covering the view
+        origin, phase = self.grid(view)
+        ranges = []
+        for start, size in zip(origin, view[0]):
+            areas = []
+            for t in xrange(start // TILE_SIZE, (start + size - 1) // TILE_SIZE + 1):
+                low = max(t * TILE_SIZE, start)
+                high = min((t + 1) * TILE_SIZE, start + size)
+                areas.append((t, slice(low - start, high - start),
+                              slice(low - t * TILE_SIZE, high - t * TILE_SIZE),
+                              high - low == TILE_SIZE))
+            ranges.append(areas)
+        for tx, view_x, tile_x, full_x in ranges[0]:
+            for ty, view_y, tile_y, full_y in ranges[1]:
+                yield ((view_x, view_y), (tile_x, tile_y), full_x and full_y,
+                       self.tile_path(view, phase, tx, ty))
+
+    def load(self, view, counts, known):
+        # Fill counts with the cached tiles of the view
+        for area, tile, full, path in self.view_tiles(view):
+            if known[area].all():
+                continue
+            try:
+                counts[area] = np.load(path, mmap_mode='r')[tile]
+            except (IOError, ValueError):
+                continue
+            known[area] = True
+            # Mark as recently used
+            os.utime(path, None)
+
+    def save(self, view, counts):
+        # Store the tiles entirely in the view that are not cached yet
+        for area, tile, full, path in self.view_tiles(view):
+            if not full or os.path.exists(path):
+                continue
+            tmp_path = "%s.%d.tmp" % (path, os.getpid())
+            with open(tmp_path, "wb") as f:
+                np.save(f, counts[area])
+            os.rename(tmp_path, path)
+            self.size += os.path.getsize(path)
+        if self.size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        tiles = sorted(self.tiles())
+        self.size = sum(map(lambda x: x[1], tiles))
+        for mtime, size, path in tiles:
+            if self.size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self.size -= size
+
+tile_cache = None
+if "PYRENDER_CACHE" in os.environ:
+    tile_cache = TileCache(os.environ["PYRENDER_CACHE"], int(float(os.environ.get("PYRENDER_CACHE_SIZE", 512)) * 1024 * 1024))
+
+# Maximum distance, in pixel, between a new pixel and a previous one to reuse it
+REUSE_TOLERANCE=1e-3
+class ViewBuffer:
+    # Iteration counts of the last rendered view (window_size, offset, scale,
+    # max_iter, c) so that the next view only computes the pixels that are
+    # not on the previous grid, e.g. after a pan or a zoom by an exact factor.
+    # Exact counts are also stored in the tile cache, unless save_tiles is
+    # unset, e.g. for animations whose views are seldom seen again.
+    def __init__(self):
+        self.view = None
+        self.save_tiles = True
+        # Results are computed alternately in two shared arrays, so that
+        # the stored counts are not overwritten by the next view
+        self.outputs = [SharedArray(), SharedArray()]
+
+    def store(self, view, counts, exact = True):
+        self.view = view
+        self.counts = counts.reshape(*view[0])
+        # Subdivision counts are approximated
+        self.exact = exact
+        if exact and self.save_tiles and tile_cache is not None:
+            tile_cache.save(view, self.counts)
+
+    def lookup(self, view, exact = True):
+        # Return new and previous indices of the reusable columns and rows
+        if self.view is None or (view[0], view[3], view[4]) != (self.view[0], self.view[3], self.view[4]):
+            return None
+        if exact and not self.exact:
+            return None
+        window_size, offset, scale = view[:3]
+        old_offset, old_scale = self.view[1:3]
+        x = np.arange(window_size[0]) * (old_scale[0] / scale[0]) + (offset[0] - old_offset[0]) * old_scale[0]
+        y = window_size[1] - (
+            (window_size[1] - np.arange(window_size[1])) * (old_scale[1] / scale[1]) +
+            (offset[1] - old_offset[1]) * old_scale[1])
+        match = []
+        for coord, size in ((x, window_size[0]), (y, window_size[1])):
+            idx = np.round(coord)
+            valid = (np.abs(coord - idx) < REUSE_TOLERANCE) & (idx >= 0) & (idx < size)
+            if not valid.any():
+                return None
+            match.extend((np.flatnonzero(valid), idx[valid].astype(int)))
+        return match
+
+    def reuse(self, view, exact = True):
+        # Return the view iteration counts filled with the previous view
+        # pixels and the cached tiles, and the mask of the known pixels
+        counts = np.zeros(view[0], dtype='i4')
+        known = np.zeros(view[0], dtype=bool)
+        match = self.lookup(view, exact)
+        if match is not None:
+            x, old_x, y, old_y = match
+            counts[np.ix_(x, y)] = self.counts[np.ix_(old_x, old_y)]
+            known[np.ix_(x, y)] = True
+        if tile_cache is not None:
+            tile_cache.load(view, counts, known)
+        if not known.any():
+            return None, None
+        return counts, known
+
+    def render(self, view, method):
+        # Return the view iteration counts, only the missing pixels are computed
+        exact = method is not subdivide_fractal
+        counts, known = self.reuse(view, exact)
+        self.outputs.reverse()
+        if counts is None:
+            tile_size = COMPUTE_TILE
+            if not exact:
+                tile_size = SUBDIVIDE_COLUMNS * view[0][1]
+            counts = compute(method, list(view) + [view[0][0] * view[0][1]], self.outputs[0], tile_size)
+        else:
+            missing = np.flatnonzero(~known)
+            if len(missing):
+                counts.flat[missing] = compute(indexed_fractal, list(view) + [PixelList(missing), len(missing)], self.outputs[0])
+        self.store(view, counts, exact)
+        return counts
+
+class EscapeTimePlane(ProgressivePlane):
+    # Scene mixin for ComplexPlane rendering the escape time of the Julia set
+    # of c, or of the Mandelbrot set when c is None, with a palette of
+    # color_factory. Scenes implement draw_overlay() and log(frame, elapsed).
+    c = None
+
+    def __init__(self, color_factory = grayscale_color_factory):
+        self.palette = Palette(color_factory)
+        self.subdivide = False
+        self.buffer = ViewBuffer()
+
+    def kernel(self):
+        if self.subdivide:
+            return subdivide_fractal
+        return complex_fractal
+
+    def interlaced(self):
+        return self.progressive and not self.subdivide
+
+    def view(self):
+        return (self.window_size, self.offset, self.scale, self.max_iter, self.c)
+
+    def prefill(self):
+        # Start from the previous view pixels when possible
+        return self.buffer.reuse(self.view())
+
+    def compute_pixels(self, pixels):
+        return compute(indexed_fractal, list(self.view()) + [PixelList(pixels), len(pixels)])
+
+    def colorize(self, counts):
+        return self.palette.get(self.max_iter)[counts]
+
+    def rendered(self, frame, counts, elapsed):
+        self.buffer.store(self.view(), counts)
+        self.log(frame, elapsed)
+
+    def render(self, frame):
+        start_time = time.time()
+        # Reuse the previous view pixels when possible
+        self.blit(self.colorize(self.buffer.render(self.view(), self.kernel())))
+        self.draw_overlay()
+        self.log(frame, time.time() - start_time)
 
 class ComplexPlane:
     def set_view(self, center = None, radius = None):
         if center is not None:
+            self.hp_center = hp_complex(center)
+            if isinstance(center, (tuple, basestring)):
+                center = complex(float(self.hp_center[0]), float(self.hp_center[1]))
             self.center = center
         if radius is not None:
             if radius == 0:
@@ -348,6 +1874,17 @@ class ComplexPlane:
             self.window_size[1] / float(plane_max[1] - plane_min[1])
         )
 
+    def move_center(self, step):
+        # Move the center without losing its precision
+        self.set_view(center = hp_add(self.hp_center, step, self.radius))
+
+    def convert_to_hp_plane(self, screen_coord):
+        # Same as convert_to_plane, without losing the center precision
+        return hp_add(self.hp_center, complex(
+            screen_coord[0] / self.scale[0] - self.radius,
+            (self.window_size[1] - screen_coord[1]) / self.scale[1] - self.radius
+        ), self.radius)
+
     def convert_to_plane(self, screen_coord):
         return complex(
             screen_coord[0] / self.scale[0] + self.offset[0],
@@ -481,7 +2018,7 @@ def main(argv):
             plane.draw_complex(point, color=(120,10,50))
 
         screen.update()
-        pygame.display.update()
+        screen.flip()
 
         for e in pygame.event.get():
             if e.type == KEYDOWN and e.key == K_ESCAPE: